@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List
+
+from aiogram import Bot
+from aiogram.types import Message
+from redis.asyncio import Redis
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumBackend(ABC):
+    """
+    Storage of album parts until the album is complete
+    """
+
+    @abstractmethod
+    async def add(self, media_group_id: str, message: Message) -> bool:
+        """
+        Store album part
+        :param media_group_id: TG media group id
+        :param message: Album part
+        :return: True if this is the first part, its handler collects the album.
+            False for the parts of the album collected already
+        """
+
+    @abstractmethod
+    async def count(self, media_group_id: str) -> int:
+        """
+        Count of the album parts received so far
+        """
+
+    @abstractmethod
+    async def pop(self, media_group_id: str, bot: Bot) -> List[Message]:
+        """
+        Take all album parts and mark the album as done
+        :param media_group_id: TG media group id
+        :param bot: Bot instance to bind the messages to
+        :return: Album parts in the arrival order
+        """
+
+    @abstractmethod
+    async def is_done(self, media_group_id: str) -> bool:
+        """
+        True if the album was already collected, the part is late
+        """
+
+
+class MemoryAlbumBackend(AlbumBackend):
+    """
+    Album parts in the process memory, for polling and dev mode
+    """
+
+    def __init__(self, done_history: int = 1000, ttl: int = 60):
+        """
+        :param done_history: Max collected albums remembered
+        :param ttl: Seconds to remember the collected album, must be longer than max wait
+        """
+        self.albums: Dict[str, List[Message]] = {}
+        self.done: LRUCache[bool] = LRUCache(
+            done_history, ttl=ttl, sizeof=lambda value: 1
+        )
+
+    async def add(self, media_group_id: str, message: Message) -> bool:
+        parts = self.albums.get(media_group_id)
+        if parts is not None:
+            parts.append(message)
+            return False
+        if self.done.get(media_group_id) is not None:
+            return False
+        self.albums[media_group_id] = [message]
+        return True
+
+    async def count(self, media_group_id: str) -> int:
+        return len(self.albums.get(media_group_id, ()))
+
+    async def pop(self, media_group_id: str, bot: Bot) -> List[Message]:
+        self.done.set(media_group_id, True)
+        return self.albums.pop(media_group_id, [])
+
+    async def is_done(self, media_group_id: str) -> bool:
+        return self.done.get(media_group_id) is not None
+
+
+class RedisAlbumBackend(AlbumBackend):
+    """
+    Album parts in Redis, so parts received by different processes and nodes
+    are collected into the single album.\r\n
+    The leader key is kept for the ttl after the album is collected, so a late part
+    can't become the leader of a new album.
+    """
+
+    key_prefix = "album:"
+
+    def __init__(self, redis: Redis, ttl: int = 60):
+        """
+        :param redis: Redis client
+        :param ttl: Seconds to keep album keys, must be longer than max wait
+        """
+        self.redis = redis
+        self.ttl = ttl
+
+    def _key(self, media_group_id: str, name: str) -> str:
+        return f"{self.key_prefix}{media_group_id}:{name}"
+
+    async def add(self, media_group_id: str, message: Message) -> bool:
+        parts_key = self._key(media_group_id, "parts")
+        leader_key = self._key(media_group_id, "leader")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(parts_key, message.model_dump_json(exclude_defaults=True))
+            pipe.expire(parts_key, self.ttl)
+            pipe.set(leader_key, 1, nx=True, ex=self.ttl)
+            _, _, is_leader = await pipe.execute()
+        return bool(is_leader)
+
+    async def count(self, media_group_id: str) -> int:
+        return await self.redis.llen(self._key(media_group_id, "parts"))
+
+    async def pop(self, media_group_id: str, bot: Bot) -> List[Message]:
+        parts_key = self._key(media_group_id, "parts")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(parts_key, 0, -1)
+            pipe.delete(parts_key)
+            pipe.expire(self._key(media_group_id, "leader"), self.ttl)
+            pipe.set(self._key(media_group_id, "done"), 1, ex=self.ttl)
+            parts, _, _, _ = await pipe.execute()
+        return [
+            Message.model_validate_json(part, context={"bot": bot}) for part in parts
+        ]
+
+    async def is_done(self, media_group_id: str) -> bool:
+        return bool(await self.redis.exists(self._key(media_group_id, "done")))
+
+
+class AlbumAggregator:
+    """
+    Collects album parts with the sliding debounce window.\r\n
+    The window restarts on each new part, so slow parts under load still get into
+    the album, max_wait limits the total delay of the album.
+    """
+
+    def __init__(self, backend: AlbumBackend, debounce: float, max_wait: float):
+        """
+        :param backend: Album parts storage
+        :param debounce: Seconds without new parts after which the album is complete
+        :param max_wait: Max seconds from the first part to the album handling
+        """
+        self.backend = backend
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.albums = 0
+        self.parts = 0
+        self.late_parts = 0
+        self.max_wait_reached = 0
+        self.delay_sum = 0.0
+        self.delay_max = 0.0
+
+    async def collect(self, message: Message) -> List[Message] | None:
+        """
+        Add album part and wait for the album
+        :param message: Album part
+        :return: Album parts for the handler of the first part, None for others
+        """
+        media_group_id = message.media_group_id
+        if not await self.backend.add(media_group_id, message):
+            if await self.backend.is_done(media_group_id):
+                # Album is sent already, the part is dropped instead of a separate document
+                self.late_parts += 1
+                logger.warning("Late part of the album %s is dropped", media_group_id)
+            return None
+
+        started_at = time.monotonic()
+        deadline = started_at + self.max_wait
+        count = await self.backend.count(media_group_id)
+        quiet_until = started_at + self.debounce
+        while (now := time.monotonic()) < min(quiet_until, deadline):
+            await asyncio.sleep(min(quiet_until, deadline) - now)
+            new_count = await self.backend.count(media_group_id)
+            if new_count != count:
+                count = new_count
+                quiet_until = time.monotonic() + self.debounce
+        if quiet_until > deadline:
+            self.max_wait_reached += 1
+
+        album = await self.backend.pop(media_group_id, message.bot)
+        delay = time.monotonic() - started_at
+        self.albums += 1
+        self.parts += len(album)
+        self.delay_sum += delay
+        self.delay_max = max(self.delay_max, delay)
+        return album or [message]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "albums": self.albums,
+            "parts": self.parts,
+            "late_parts": self.late_parts,
+            "max_wait_reached": self.max_wait_reached,
+            "delay_avg": self.delay_sum / self.albums if self.albums else 0.0,
+            "delay_max": self.delay_max,
+        }
@@ -0,0 +1,233 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import Message, MessageEntity, PhotoSize
+from redis.asyncio import Redis
+
+from images import ImagePolicy, select_photo
+
+# Entry: [message id, text, entities, photos]
+# Entity: [type, offset, length, url, language]
+# Photo: [file id, file unique id, width, height, file size]
+BatchEntry = List[Any]
+
+
+class BatchState(StatesGroup):
+    collecting = State()
+
+
+def pack_message(
+    message: Message,
+    album: List[Message] | None = None,
+    image_policy: ImagePolicy | str = ImagePolicy.ORIGINAL,
+) -> BatchEntry:
+    """
+    Compact JSON friendly form of the message, only what the conversion needs
+    :param message: TG Message, the album part with caption for albums
+    :param album: Album parts in the message order
+    :param image_policy: User image policy, decides which photo sizes are kept
+    :return: Batch entry
+    """
+    text = message.text if message.text is not None else message.caption
+    entities = (
+        message.entities if message.text is not None else message.caption_entities
+    )
+    photos = [
+        select_photo(part.photo, image_policy)
+        for part in album or [message]
+        if part.photo
+    ]
+    return [
+        min(part.message_id for part in album or [message]),
+        text or "",
+        [
+            [entity.type, entity.offset, entity.length, entity.url, entity.language]
+            for entity in entities or ()
+        ],
+        [
+            [
+                photo.file_id,
+                photo.file_unique_id,
+                photo.width,
+                photo.height,
+                photo.file_size,
+            ]
+            for photo in photos
+        ],
+    ]
+
+
+def unpack_entities(entry: BatchEntry) -> List[MessageEntity]:
+    return [
+        MessageEntity(
+            type=type_, offset=offset, length=length, url=url, language=language
+        )
+        for type_, offset, length, url, language in entry[2]
+    ]
+
+
+def unpack_photos(entry: BatchEntry) -> List[PhotoSize]:
+    return [
+        PhotoSize(
+            file_id=file_id,
+            file_unique_id=file_unique_id,
+            width=width,
+            height=height,
+            file_size=file_size,
+        )
+        for file_id, file_unique_id, width, height, file_size in entry[3]
+    ]
+
+
+class BatchBackend(ABC):
+    """
+    Storage of the batch entries, appending an entry doesn't read the batch
+    """
+
+    @abstractmethod
+    async def push(self, key: str, entry: BatchEntry, max_messages: int) -> int | None:
+        """
+        Append entry to the batch
+        :param key: Batch key
+        :param entry: Packed message
+        :param max_messages: Max entries in the batch
+        :return: Entries count, None if the batch is full and the entry is not added
+        """
+
+    @abstractmethod
+    async def pop(self, key: str) -> List[BatchEntry]:
+        """
+        Take all entries and remove the batch
+        :param key: Batch key
+        :return: Entries in the arrival order
+        """
+
+
+class MemoryBatchBackend(BatchBackend):
+    """
+    Batches in the process memory, for dev mode
+    """
+
+    def __init__(self):
+        self.batches: Dict[str, List[BatchEntry]] = {}
+
+    async def push(self, key: str, entry: BatchEntry, max_messages: int) -> int | None:
+        entries = self.batches.setdefault(key, [])
+        if len(entries) >= max_messages:
+            return None
+        entries.append(entry)
+        return len(entries)
+
+    async def pop(self, key: str) -> List[BatchEntry]:
+        return self.batches.pop(key, [])
+
+
+class RedisBatchBackend(BatchBackend):
+    """
+    Batches in the Redis lists, a new entry costs a single RPUSH
+    """
+
+    key_prefix = "batch:"
+
+    def __init__(self, redis: Redis, ttl: int):
+        """
+        :param redis: Redis client
+        :param ttl: Seconds to keep the batch after its last entry
+        """
+        self.redis = redis
+        self.ttl = ttl
+
+    async def push(self, key: str, entry: BatchEntry, max_messages: int) -> int | None:
+        key = self.key_prefix + key
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps(entry, ensure_ascii=False))
+            pipe.expire(key, self.ttl)
+            count, _ = await pipe.execute()
+        if count > max_messages:
+            # Entries of the chat are added under the lock, nothing was added after it
+            await self.redis.rpop(key)
+            return None
+        return count
+
+    async def pop(self, key: str) -> List[BatchEntry]:
+        key = self.key_prefix + key
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            entries, _ = await pipe.execute()
+        return [json.loads(entry) for entry in entries]
+
+
+class BatchStore:
+    """
+    Batch entries of the chat, the batch mode itself is the FSM state.\r\n
+    Forwarded messages arrive together and are handled concurrently, so updates
+    of the same chat batch are serialized. All updates of the chat are handled
+    by the same process, so the process-local lock is enough.
+    """
+
+    def __init__(self, backend: BatchBackend, max_messages: int):
+        """
+        :param backend: Batch entries storage
+        :param max_messages: Max entries in the single batch
+        """
+        self.backend = backend
+        self.max_messages = max_messages
+        # chat key -> (lock, handlers holding or waiting for it)
+        self.locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+
+    async def start(self, state: FSMContext) -> None:
+        async with self._lock(state):
+            await state.set_state(BatchState.collecting)
+            # Entries of the previous batch which was not finished
+            await self.backend.pop(self._key(state))
+
+    async def add(self, state: FSMContext, entry: BatchEntry) -> int | None:
+        """
+        Append entry to the batch
+        :param state: FSM Context
+        :param entry: Packed message
+        :return: Entries count, None if the batch is full
+        """
+        async with self._lock(state):
+            return await self.backend.push(self._key(state), entry, self.max_messages)
+
+    async def pop(self, state: FSMContext) -> List[BatchEntry] | None:
+        """
+        Finish the batch
+        :param state: FSM Context
+        :return: Entries in the message order, None if the batch was not started
+        """
+        async with self._lock(state):
+            if await state.get_state() != BatchState.collecting.state:
+                return None
+            entries = await self.backend.pop(self._key(state))
+            await state.set_state(None)
+        return sorted(entries, key=lambda entry: entry[0])
+
+    @staticmethod
+    def _key(state: FSMContext) -> str:
+        key = state.key
+        return f"{key.bot_id}:{key.chat_id}:{key.thread_id or ''}:{key.user_id}"
+
+    @asynccontextmanager
+    async def _lock(self, state: FSMContext) -> AsyncIterator[None]:
+        key = self._key(state)
+        lock, users = self.locks.get(key, (None, 0))
+        lock = lock or asyncio.Lock()
+        self.locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.locks[key]
+            if users > 1:
+                self.locks[key] = (lock, users - 1)
+            else:
+                # Nobody else waits, do not keep locks of all chats ever seen
+                del self.locks[key]
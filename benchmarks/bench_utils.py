@@ -0,0 +1,425 @@
+"""
+Benchmarks for utils.parse_html_to_md.
+
+Run from the repository root:
+    python -m benchmarks.bench_utils
+    python -m benchmarks.bench_utils --update-baseline
+    python -m benchmarks.bench_utils --threshold 15
+
+Latency depends on the machine, the baseline stores the machine it was measured on
+and latency is compared only on the same machine. Memory is compared on the same
+Python version.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from aiogram.enums import MessageEntityType
+from aiogram.types import MessageEntity
+
+from utils import parse_html_to_md
+
+MAX_MESSAGE_LENGTH = 4096
+BASELINE_PATH = Path(__file__).parent.resolve() / "baseline.json"
+
+WORDS = [
+    "telegram",
+    "markdown",
+    "message",
+    "bot",
+    "format",
+    "entity",
+    "offset",
+    "привет",
+    "мир",
+    "текст",
+]
+LANGUAGES = ["python", "js", "go", "rust", ""]
+CUSTOM_EMOJI = ["😀", "🔥", "👍", "🚀"]
+
+
+@dataclass
+class Case:
+    name: str
+    text: str
+    entities: List[MessageEntity]
+
+
+@dataclass
+class CaseResult:
+    name: str
+    chars: int
+    entities: int
+    messages_per_sec: float
+    chars_per_sec: float
+    p50_us: float
+    p99_us: float
+    peak_alloc_kb: float
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+class MessageBuilder:
+    """
+    Collect text pieces and their entities with telegram UTF-16 offsets
+    """
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.entities: List[MessageEntity] = []
+        self.length = 0
+        self.utf16_length = 0
+
+    def add(self, text: str, *entity_types: str, **entity_kwargs) -> None:
+        text_len = utf16_len(text)
+        for entity_type in entity_types:
+            self.entities.append(
+                MessageEntity(
+                    type=entity_type,
+                    offset=self.utf16_length,
+                    length=text_len,
+                    **entity_kwargs,
+                )
+            )
+        self.parts.append(text)
+        self.length += len(text)
+        self.utf16_length += text_len
+
+    def fits(self, text: str) -> bool:
+        return self.length + len(text) <= MAX_MESSAGE_LENGTH
+
+    def build(self, name: str) -> Case:
+        return Case(name=name, text="".join(self.parts), entities=self.entities)
+
+
+def gen_plain_sentence(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    builder.add(" ".join(rnd.choices(WORDS, k=12)) + ".")
+    return builder.build("plain_sentence")
+
+
+def gen_short_formatted(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    for entity_type in (
+        MessageEntityType.BOLD,
+        MessageEntityType.ITALIC,
+        MessageEntityType.CODE,
+    ):
+        builder.add(" ".join(rnd.choices(WORDS, k=4)) + " ")
+        builder.add(rnd.choice(WORDS), entity_type)
+        builder.add(" ")
+    return builder.build("short_formatted")
+
+
+def gen_max_plain(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    while True:
+        word = rnd.choice(WORDS) + " "
+        if not builder.fits(word):
+            break
+        builder.add(word)
+    return builder.build("max_length_plain")
+
+
+def gen_max_dense_nested(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    nested = [
+        MessageEntityType.BOLD,
+        MessageEntityType.ITALIC,
+        MessageEntityType.UNDERLINE,
+        MessageEntityType.STRIKETHROUGH,
+    ]
+    while True:
+        word = rnd.choice(WORDS)
+        if not builder.fits(word + " "):
+            break
+        builder.add(word, *rnd.sample(nested, rnd.randint(1, len(nested))))
+        builder.add(" ")
+    return builder.build("max_length_dense_nested")
+
+
+def gen_max_links(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    index = 0
+    while True:
+        word = rnd.choice(WORDS)
+        if not builder.fits(word + " "):
+            break
+        builder.add(
+            word, MessageEntityType.TEXT_LINK, url=f"https://example.com/{index}"
+        )
+        builder.add(" ")
+        index += 1
+    return builder.build("max_length_text_links")
+
+
+def gen_max_pre(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    while True:
+        code = "\n".join(
+            f"{rnd.choice(WORDS)} = {rnd.randint(0, 1000)}" for _ in range(5)
+        )
+        if not builder.fits(code + "\n"):
+            break
+        builder.add(code, MessageEntityType.PRE, language=rnd.choice(LANGUAGES))
+        builder.add("\n")
+    return builder.build("max_length_pre_blocks")
+
+
+def gen_max_custom_emoji(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    while True:
+        word = rnd.choice(WORDS) + " "
+        emoji = rnd.choice(CUSTOM_EMOJI)
+        if not builder.fits(word + emoji + " "):
+            break
+        builder.add(word)
+        builder.add(
+            emoji,
+            MessageEntityType.CUSTOM_EMOJI,
+            custom_emoji_id=str(rnd.randint(10**17, 10**18)),
+        )
+        builder.add(" ", MessageEntityType.BOLD)
+    return builder.build("max_length_custom_emoji")
+
+
+def gen_max_mixed(rnd: random.Random) -> Case:
+    builder = MessageBuilder()
+    generators: List[Callable[[], None]] = [
+        lambda: builder.add(rnd.choice(WORDS), MessageEntityType.BOLD),
+        lambda: builder.add(
+            rnd.choice(WORDS), MessageEntityType.BOLD, MessageEntityType.ITALIC
+        ),
+        lambda: builder.add(
+            rnd.choice(WORDS), MessageEntityType.TEXT_LINK, url="https://example.com"
+        ),
+        lambda: builder.add(rnd.choice(WORDS), MessageEntityType.CODE),
+        lambda: builder.add(
+            rnd.choice(CUSTOM_EMOJI),
+            MessageEntityType.CUSTOM_EMOJI,
+            custom_emoji_id="5368324170671202286",
+        ),
+        lambda: builder.add(
+            "print('hi')\n", MessageEntityType.PRE, language=rnd.choice(LANGUAGES)
+        ),
+    ]
+    while builder.fits(" " * 32):
+        rnd.choice(generators)()
+        builder.add(" ")
+    return builder.build("max_length_mixed")
+
+
+CASE_GENERATORS: List[Callable[[random.Random], Case]] = [
+    gen_plain_sentence,
+    gen_short_formatted,
+    gen_max_plain,
+    gen_max_dense_nested,
+    gen_max_links,
+    gen_max_pre,
+    gen_max_custom_emoji,
+    gen_max_mixed,
+]
+
+
+def build_cases(seed: int) -> List[Case]:
+    rnd = random.Random(seed)
+    return [generator(rnd) for generator in CASE_GENERATORS]
+
+
+def measure_latencies(case: Case, iterations: int) -> List[float]:
+    for _ in range(min(iterations, 50)):
+        parse_html_to_md(case.text, case.entities)
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        parse_html_to_md(case.text, case.entities)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def measure_peak_alloc(case: Case) -> int:
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        parse_html_to_md(case.text, case.entities)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_case(case: Case, iterations: int) -> CaseResult:
+    latencies = measure_latencies(case, iterations)
+    total = sum(latencies)
+    quantiles = statistics.quantiles(latencies, n=100)
+    return CaseResult(
+        name=case.name,
+        chars=len(case.text),
+        entities=len(case.entities),
+        messages_per_sec=iterations / total,
+        chars_per_sec=iterations * len(case.text) / total,
+        p50_us=quantiles[49] * 1e6,
+        p99_us=quantiles[98] * 1e6,
+        peak_alloc_kb=measure_peak_alloc(case) / 1024,
+    )
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def machine_info() -> Dict[str, Any]:
+    return {
+        "cpu": cpu_model(),
+        "cpu_count": os.cpu_count(),
+        "system": platform.system(),
+        "python": f"{platform.python_implementation()} {platform.python_version()}",
+    }
+
+
+def print_results(results: List[CaseResult]) -> None:
+    header = (
+        f"{'case':<26}{'chars':>7}{'ents':>6}{'msg/s':>11}"
+        f"{'chars/s':>13}{'p50 us':>10}{'p99 us':>10}{'peak KiB':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result.name:<26}{result.chars:>7}{result.entities:>6}"
+            f"{result.messages_per_sec:>11.0f}{result.chars_per_sec:>13.0f}"
+            f"{result.p50_us:>10.1f}{result.p99_us:>10.1f}{result.peak_alloc_kb:>10.1f}"
+        )
+
+
+def compare_with_baseline(
+    results: List[CaseResult],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+    min_delta: float,
+    metrics: Tuple[str, ...] = ("p50_us", "peak_alloc_kb"),
+) -> List[Tuple[str, str, float, float]]:
+    """
+    Compare results with the stored baseline.
+    p99 is stored for reference only, it is too noisy to gate on.
+    :param results: Current run results
+    :param baseline: Case name -> stored metrics
+    :param threshold: Allowed regression in percent
+    :param min_delta: Absolute difference ignored as noise (us / KiB)
+    :param metrics: Compared metrics
+    :return: List of (case, metric, baseline value, current value) regressions
+    """
+    regressions = []
+    for result in results:
+        stored = baseline.get(result.name)
+        if not stored:
+            continue
+        for metric in metrics:
+            if metric not in stored:
+                continue
+            current = getattr(result, metric)
+            if current - stored[metric] <= min_delta:
+                continue
+            if current > stored[metric] * (1 + threshold / 100):
+                regressions.append((result.name, metric, stored[metric], current))
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="parse_html_to_md benchmarks")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=25.0,
+        help="Allowed regression against the baseline, percent",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=5.0,
+        help="Absolute difference ignored as noise, us for latency and KiB for memory",
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store current results as the new baseline",
+    )
+    args = parser.parse_args()
+
+    results = [run_case(case, args.iterations) for case in build_cases(args.seed)]
+    print_results(results)
+
+    machine = machine_info()
+    if args.update_baseline:
+        baseline = {
+            "machine": machine,
+            "cases": {
+                result.name: {
+                    "p50_us": round(result.p50_us, 2),
+                    "p99_us": round(result.p99_us, 2),
+                    "peak_alloc_kb": round(result.peak_alloc_kb, 2),
+                }
+                for result in results
+            },
+        }
+        args.baseline.write_text(
+            json.dumps(baseline, indent=2, ensure_ascii=False) + "\n"
+        )
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"\nNo baseline at {args.baseline}, run with --update-baseline")
+        return 0
+
+    baseline = json.loads(args.baseline.read_text())
+    stored_machine = baseline.get("machine", {})
+    metrics = ("p50_us", "peak_alloc_kb")
+    if stored_machine != machine:
+        print(
+            f"\nBaseline was measured on {stored_machine or 'unknown machine'},"
+            f" this is {machine}: latency is not compared,"
+            " run with --update-baseline on this machine to compare it"
+        )
+        metrics = ("peak_alloc_kb",)
+        if stored_machine.get("python") != machine["python"]:
+            metrics = ()
+    regressions = compare_with_baseline(
+        results, baseline.get("cases", {}), args.threshold, args.min_delta, metrics
+    )
+    if not regressions:
+        print(
+            f"\nNo regressions over {args.threshold}% against baseline"
+            f" ({', '.join(metrics) or 'nothing compared'})"
+        )
+        return 0
+    print(f"\nRegressions over {args.threshold}% against baseline:")
+    for name, metric, stored, current in regressions:
+        print(f"  {name}.{metric}: {stored:.1f} -> {current:.1f}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
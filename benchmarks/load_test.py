@@ -0,0 +1,389 @@
+"""
+End-to-end load test of the bot against a local fake Bot API server.
+
+The real dispatcher and bot from main.py poll the fake server, which serves scripted
+updates, files of the given size and accepts the bot answers. No requests go
+to Telegram. Every converted message carries a unique token, the documents are
+matched to their messages by it. Messages answered with "too busy" by the fair
+scheduler are reported as rejected.
+
+Run from the repository root (BOT_TOKEN and other required settings from .env):
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --users 100 --messages 20 --mix text=1,caption=1,album=1
+    python -m benchmarks.load_test --api-latency 0.05 --file-latency 0.2 --photo-size 500000
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import re
+import resource
+import statistics
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Load test bot", "username": "bot"}
+WORDS = ["telegram", "markdown", "message", "формат", "текст", "load", "test"]
+# "-" is not in the base64 alphabet, photos in the document never match
+TOKEN_PATTERN = re.compile(rb"msg-(\d{8})")
+
+
+@dataclass
+class Scenario:
+    users: int = 20
+    messages: int = 10
+    # Message kind -> weight
+    mix: Dict[str, float] = field(
+        default_factory=lambda: {"text": 1.0, "caption": 1.0, "album": 1.0}
+    )
+    album_size: int = 4
+    photo_size: int = 100_000
+    api_latency: float = 0.0
+    file_latency: float = 0.0
+    # Seconds between messages of the single user
+    think_time: float = 0.0
+    timeout: float = 120.0
+    seed: int = 42
+
+
+class FakeBotAPI:
+    """
+    Minimal Bot API: getUpdates long polling with the scripted updates,
+    getFile and file downloads, and the methods the bot answers with
+    """
+
+    def __init__(self, scenario: Scenario):
+        self.scenario = scenario
+        self.updates: List[Dict[str, Any]] = []
+        self.new_updates = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_content = random.Random(scenario.seed).randbytes(scenario.photo_size)
+        self.tokens = itertools.count(1)
+        self.calls: Counter[str] = Counter()
+        # message token -> time the message was sent
+        self.sent_at: Dict[int, float] = {}
+        self.latencies: List[float] = []
+        # Documents without a known token, e.g. sent twice
+        self.unmatched = 0
+        # chat id -> "too busy" answers
+        self.rejected: Counter[int] = Counter()
+        # "too busy" text of the default locale, set when the bot is started
+        self.busy_text: str | None = None
+        self.uploaded_bytes = 0
+        self.completed = asyncio.Event()
+        self.expected = 0
+
+    @property
+    def answered(self) -> int:
+        return len(self.latencies) + sum(self.rejected.values())
+
+    def check_completed(self) -> None:
+        if self.expected and self.answered >= self.expected:
+            self.completed.set()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        return app
+
+    def push_update(self, message: Dict[str, Any], token: int | None = None) -> None:
+        """
+        :param message: Update message
+        :param token: Token of the converted message, None - the message is not converted by itself
+        """
+        self.updates.append({"update_id": next(self.update_ids), "message": message})
+        if token is not None:
+            self.sent_at[token] = time.perf_counter()
+        self.new_updates.set()
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        if method != "getUpdates" and self.scenario.api_latency:
+            await asyncio.sleep(self.scenario.api_latency)
+        handler = getattr(self, f"method_{method}", None)
+        result = await handler(data) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.calls["file"] += 1
+        if self.scenario.file_latency:
+            await asyncio.sleep(self.scenario.file_latency)
+        return web.Response(body=self.file_content)
+
+    async def method_getMe(self, data) -> Dict[str, Any]:
+        return BOT_USER
+
+    async def method_getUpdates(self, data) -> List[Dict[str, Any]]:
+        offset = int(data.get("offset") or 0)
+        timeout = float(data.get("timeout") or 0)
+        self.updates = [
+            update for update in self.updates if update["update_id"] >= offset
+        ]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def method_getFile(self, data) -> Dict[str, Any]:
+        return {
+            "file_id": data["file_id"],
+            "file_unique_id": data["file_id"],
+            "file_size": len(self.file_content),
+            "file_path": f"photos/{data['file_id']}.jpg",
+        }
+
+    def _message(self, data, **fields: Any) -> Dict[str, Any]:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    async def method_sendDocument(self, data) -> Dict[str, Any]:
+        # Uploaded file is attached as a separate field, document is "attach://<field>"
+        now = time.perf_counter()
+        matched = False
+        for value in data.values():
+            if not isinstance(value, web.FileField):
+                continue
+            content = value.file.read()
+            self.uploaded_bytes += len(content)
+            for token in TOKEN_PATTERN.findall(content):
+                sent_at = self.sent_at.pop(int(token), None)
+                if sent_at is not None:
+                    self.latencies.append(now - sent_at)
+                    matched = True
+        self.unmatched += not matched
+        self.check_completed()
+        return self._message(
+            data,
+            document={"file_id": f"doc{len(self.latencies)}", "file_unique_id": "doc"},
+        )
+
+    async def method_sendMessage(self, data) -> Dict[str, Any]:
+        if data.get("text") == self.busy_text:
+            self.rejected[int(data["chat_id"])] += 1
+            self.check_completed()
+        return self._message(data, text=data.get("text", ""))
+
+    async def method_editMessageText(self, data) -> Dict[str, Any]:
+        return self._message(data, text=data.get("text", ""))
+
+
+def random_text(rng: random.Random, token: int) -> Dict[str, Any]:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 60))]
+    # Unique text, so the conversion cache does not answer instead of the bot
+    text = f"msg-{token:08d} " + " ".join(words)
+    return {
+        "text": text,
+        "entities": [{"type": "bold", "offset": 0, "length": 12}],
+    }
+
+
+def photo(rng: random.Random, size: int) -> List[Dict[str, Any]]:
+    file_id = f"photo{rng.getrandbits(64):x}"
+    return [
+        {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "width": 1280,
+            "height": 960,
+            "file_size": size,
+        }
+    ]
+
+
+async def drive_user(
+    api: FakeBotAPI, scenario: Scenario, user_id: int, rng: random.Random
+) -> None:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    kinds = list(scenario.mix)
+    weights = [scenario.mix[kind] for kind in kinds]
+    for _ in range(scenario.messages):
+        kind = rng.choices(kinds, weights)[0]
+        base = {"date": int(time.time()), "chat": chat, "from": user}
+        token = next(api.tokens)
+        text = random_text(rng, token)
+        if kind == "text":
+            api.push_update(
+                {**base, "message_id": next(api.message_ids), **text}, token
+            )
+        elif kind == "caption":
+            api.push_update(
+                {
+                    **base,
+                    "message_id": next(api.message_ids),
+                    "photo": photo(rng, scenario.photo_size),
+                    "caption": text["text"],
+                    "caption_entities": text["entities"],
+                },
+                token,
+            )
+        else:
+            media_group_id = f"{rng.getrandbits(64)}"
+            for index in range(scenario.album_size):
+                part = {
+                    **base,
+                    "message_id": next(api.message_ids),
+                    "media_group_id": media_group_id,
+                    "photo": photo(rng, scenario.photo_size),
+                }
+                if index == 0:
+                    part.update(caption=text["text"], caption_entities=text["entities"])
+                api.push_update(part, token if index == 0 else None)
+        if scenario.think_time:
+            await asyncio.sleep(scenario.think_time)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+async def run(scenario: Scenario) -> Dict[str, Any]:
+    # Imported here: main reads the settings and creates the dispatcher on import
+    import main
+    from config import config
+
+    # Dev mode answers only to the admins, let the load test users in
+    config.BOT_ADMIN_CHAT_ID = [
+        *config.BOT_ADMIN_CHAT_ID,
+        *(str(user_id) for user_id in range(1000, 1000 + scenario.users)),
+    ]
+
+    api = FakeBotAPI(scenario)
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    # The bot of main.py, with the outbound scheduler and its Telegram limits
+    bot = main.create_bot()
+    bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    await main.prepare_dispatcher()
+    api.busy_text = main.dp["i18n_middleware"].core.get("too-busy", "en")
+    polling = asyncio.create_task(
+        main.dp.start_polling(bot, handle_signals=False, polling_timeout=1)
+    )
+
+    rng = random.Random(scenario.seed)
+    users = [
+        drive_user(api, scenario, user_id, random.Random(rng.getrandbits(64)))
+        for user_id in range(1000, 1000 + scenario.users)
+    ]
+    started_at = time.perf_counter()
+    await asyncio.gather(*users)
+    api.expected = next(api.tokens) - 1
+    api.check_completed()
+    try:
+        await asyncio.wait_for(api.completed.wait(), scenario.timeout)
+    except asyncio.TimeoutError:
+        logging.error("Timeout: %s of %s answered", api.answered, api.expected)
+    elapsed = time.perf_counter() - started_at
+
+    await main.dp.stop_polling()
+    await polling
+    await runner.cleanup()
+
+    conversions = len(api.latencies)
+    calls = {
+        method: count
+        for method, count in api.calls.items()
+        if method not in ("getUpdates", "getMe")
+    }
+    rejected = sum(api.rejected.values())
+    return {
+        "messages": api.expected,
+        "conversions": conversions,
+        # Answered with "too busy" by the fair scheduler
+        "rejected": rejected,
+        "unanswered": max(api.expected - conversions - rejected, 0),
+        "unmatched_documents": api.unmatched,
+        "seconds": round(elapsed, 3),
+        "throughput_per_s": round(conversions / elapsed, 2) if elapsed else 0.0,
+        "latency_s": {
+            "p50": round(percentile(api.latencies, 50), 4),
+            "p90": round(percentile(api.latencies, 90), 4),
+            "p99": round(percentile(api.latencies, 99), 4),
+            "max": round(max(api.latencies, default=0.0), 4),
+            "mean": round(statistics.fmean(api.latencies), 4) if api.latencies else 0.0,
+        },
+        "api_calls_per_conversion": {
+            method: round(count / conversions, 2) if conversions else 0.0
+            for method, count in sorted(calls.items())
+        },
+        "uploaded_mib": round(api.uploaded_bytes / 2**20, 2),
+        # Fake server runs in the same process, its share is the file content only
+        "peak_rss_mib": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in ("text", "caption", "album"):
+            raise argparse.ArgumentTypeError(f"Unknown message kind {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=Scenario.users)
+    parser.add_argument("--messages", type=int, default=Scenario.messages)
+    parser.add_argument(
+        "--mix", type=parse_mix, default=None, help="text=1,caption=1,album=1"
+    )
+    parser.add_argument("--album-size", type=int, default=Scenario.album_size)
+    parser.add_argument("--photo-size", type=int, default=Scenario.photo_size)
+    parser.add_argument("--api-latency", type=float, default=Scenario.api_latency)
+    parser.add_argument("--file-latency", type=float, default=Scenario.file_latency)
+    parser.add_argument("--think-time", type=float, default=Scenario.think_time)
+    parser.add_argument("--timeout", type=float, default=Scenario.timeout)
+    parser.add_argument("--seed", type=int, default=Scenario.seed)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    scenario = Scenario(
+        users=args.users,
+        messages=args.messages,
+        album_size=args.album_size,
+        photo_size=args.photo_size,
+        api_latency=args.api_latency,
+        file_latency=args.file_latency,
+        think_time=args.think_time,
+        timeout=args.timeout,
+        seed=args.seed,
+    )
+    if args.mix:
+        scenario.mix = args.mix
+    print(json.dumps(asyncio.run(run(scenario)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    List,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import MessageEntity
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LRUCache(Generic[T]):
+    """
+    In-process LRU cache limited by the total size of values.\r\n
+    By default size of the value is its length in bytes, pass sizeof=lambda value: 1
+    to limit by the count of items.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float | None = None,
+        sizeof: Callable[[T], int] = len,
+    ):
+        """
+        :param max_size: Max total size of the values
+        :param ttl: Time to live of the item in seconds, None - forever
+        :param sizeof: Value size function
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size, expire at)
+        self._data: OrderedDict[Hashable, Tuple[T, int, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> T | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, _, expire_at = item
+        if expire_at and expire_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: T) -> None:
+        size = self.sizeof(value)
+        if key in self._data:
+            self._remove(key)
+        if size > self.max_size:
+            return
+        expire_at = time.monotonic() + self.ttl if self.ttl else 0
+        self._data[key] = (value, size, expire_at)
+        self.size += size
+        while self.size > self.max_size:
+            oldest_key = next(iter(self._data))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        if key in self._data:
+            self._remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "items": len(self._data),
+            "size": self.size,
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._data.pop(key)
+        self.size -= size
+
+
+class TieredCache(Generic[T]):
+    """
+    Two-tier cache: in-process LRU and optional shared Redis tier with TTL.\r\n
+    Redis errors are logged and handled as cache misses.
+    """
+
+    key_prefix = ""
+
+    def __init__(self, memory: LRUCache[T], ttl: int, redis: Redis | None = None):
+        """
+        :param memory: In-process tier
+        :param ttl: Time to live of the items in seconds
+        :param redis: Redis client for the shared tier
+        """
+        self.memory = memory
+        self.redis = redis
+        self.ttl = ttl
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def decode(self, value: bytes) -> T:
+        return value
+
+    async def get(self, key: str) -> T | None:
+        value = self.memory.get(key)
+        if value is not None or self.redis is None:
+            return value
+        try:
+            raw_value = await self.redis.get(self.key_prefix + key)
+        except Exception as ex:
+            logger.error("Cannot get %s from redis cache: %s", self.key_prefix, ex)
+            return None
+        if raw_value is None:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        value = self.decode(raw_value)
+        self.memory.set(key, value)
+        return value
+
+    async def set(self, key: str, value: T) -> None:
+        self.memory.set(key, value)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.set(self.key_prefix + key, value, ex=self.ttl)
+        except Exception as ex:
+            logger.error("Cannot put %s to redis cache: %s", self.key_prefix, ex)
+
+    async def delete(self, key: str) -> None:
+        self.memory.delete(key)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.delete(self.key_prefix + key)
+        except Exception as ex:
+            logger.error("Cannot delete %s from redis cache: %s", self.key_prefix, ex)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory": self.memory.stats(),
+            "redis": {"hits": self.redis_hits, "misses": self.redis_misses},
+        }
+
+
+class MediaCache(TieredCache[bytes]):
+    """
+    Downloaded media cache keyed by TG file_unique_id.\r\n
+    The same file has the same file_unique_id for all users and bots,
+    so forwarded photos are downloaded only once.
+    Only small files go to the Redis tier, in the background, and the bytes written
+    to it within the ttl are limited, so the shared Redis stays bounded.
+    """
+
+    key_prefix = "media:"
+    written_key = "media-written"
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: int,
+        redis: Redis | None = None,
+        redis_max_item_bytes: int = 512 * 1024,
+        redis_max_bytes: int = 256 * 1024 * 1024,
+    ):
+        """
+        :param max_bytes: Max size of the in-process tier in bytes
+        :param ttl: Time to live of the items in seconds
+        :param redis: Redis client for the shared tier
+        :param redis_max_item_bytes: Larger files are kept in the process only
+        :param redis_max_bytes: Max bytes written to Redis within the ttl, the tier holds less than twice as much
+        """
+        super().__init__(LRUCache(max_bytes, ttl=ttl), ttl=ttl, redis=redis)
+        self.redis_max_item_bytes = redis_max_item_bytes
+        self.redis_max_bytes = redis_max_bytes
+        self.redis_skipped = 0
+        self.writes: Set[asyncio.Task] = set()
+
+    async def set(self, key: str, value: bytes) -> None:
+        self.memory.set(key, value)
+        if self.redis is None or len(value) > self.redis_max_item_bytes:
+            return
+        # Downloads don't wait for Redis
+        task = asyncio.create_task(self._store(key, value))
+        self.writes.add(task)
+        task.add_done_callback(self.writes.discard)
+
+    async def _store(self, key: str, value: bytes) -> None:
+        try:
+            # Bytes written in the current ttl window, items of the previous window
+            # expire within the ttl, so the tier never exceeds two budgets
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.incrby(self.written_key, len(value))
+                pipe.expire(self.written_key, self.ttl, nx=True)
+                written, _ = await pipe.execute()
+            if written > self.redis_max_bytes:
+                self.redis_skipped += 1
+                return
+            await self.redis.set(self.key_prefix + key, value, ex=self.ttl)
+        except Exception as ex:
+            logger.error("Cannot put %s to redis cache: %s", self.key_prefix, ex)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["redis"]["skipped"] = self.redis_skipped
+        return stats
+
+
+def conversion_key(
+    text: str | None,
+    entities: List[MessageEntity] | None,
+    file_unique_ids: Iterable[str] = (),
+    output_mode: str = "",
+    image_policy: str = "",
+) -> str:
+    """
+    Hash of everything the converted document depends on
+    :param text: Message text or caption
+    :param entities: Message entities
+    :param file_unique_ids: Media file_unique_ids in the document order
+    :param output_mode: User output mode
+    :param image_policy: User image policy of the documents with media
+    :return: Hex digest
+    """
+    digest = hashlib.sha256(f"{output_mode}\0".encode("utf-8"))
+    if image_policy:
+        digest.update(f"{image_policy}\0".encode("utf-8"))
+    digest.update((text or "").encode("utf-8", errors="surrogatepass"))
+    for entity in entities or ():
+        digest.update(
+            f"\0{entity.type}:{entity.offset}:{entity.length}:"
+            f"{entity.url or ''}:{entity.language or ''}".encode("utf-8")
+        )
+    for file_unique_id in file_unique_ids:
+        digest.update(f"\1{file_unique_id}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ConversionCache(TieredCache[str]):
+    """
+    Converted documents cache: conversion key -> TG file_id of the uploaded document.\r\n
+    Repeated conversions of the same content are answered with the file_id,
+    without downloading, encoding and uploading anything.
+    """
+
+    key_prefix = "conversion:"
+
+    def __init__(self, max_items: int, ttl: int, redis: Redis | None = None):
+        """
+        :param max_items: Max items count of the in-process tier
+        :param ttl: Time to live of the items in seconds
+        :param redis: Redis client for the shared tier
+        """
+        super().__init__(
+            LRUCache(max_items, ttl=ttl, sizeof=lambda value: 1), ttl=ttl, redis=redis
+        )
+
+    def decode(self, value: bytes) -> str:
+        return value.decode("utf-8")
+
+
+class LocaleCache:
+    """
+    In-process cache of the user locales in front of the FSM storage.\r\n
+    Items are keyed by the FSM storage key, the same user has separate data per chat.
+    Every process keeps its own copy, so with the shared storage a locale change
+    is published to the Redis channel and the other processes drop their copy.
+    """
+
+    channel = "locale:invalidate"
+
+    def __init__(self, max_items: int, ttl: float, redis: Redis | None = None):
+        """
+        :param max_items: Max storage keys count
+        :param ttl: Time to live of the items in seconds
+        :param redis: Redis client for the invalidation messages
+        """
+        # storage key -> locale, empty string if the user has not chosen one
+        self.memory: LRUCache[str] = LRUCache(
+            max_items, ttl=ttl, sizeof=lambda value: 1
+        )
+        self.redis = redis
+        self.instance_id = uuid.uuid4().hex
+        self.invalidations = 0
+        self.listener: asyncio.Task | None = None
+
+    def get(self, key: StorageKey) -> str | None:
+        return self.memory.get(key)
+
+    def put(self, key: StorageKey, locale: str) -> None:
+        """
+        Remember locale read from the storage, nothing is published
+        """
+        self.memory.set(key, locale)
+
+    async def set(self, key: StorageKey, locale: str) -> None:
+        """
+        Remember changed locale and invalidate it in the other processes
+        """
+        self.memory.set(key, locale)
+        if self.redis is None:
+            return
+        message = json.dumps(dataclasses.asdict(key))
+        try:
+            await self.redis.publish(self.channel, f"{self.instance_id}:{message}")
+        except Exception as ex:
+            logger.error("Cannot publish locale invalidation: %s", ex)
+
+    def start(self) -> None:
+        if self.redis is not None and self.listener is None:
+            self.listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self.listener is None:
+            return
+        self.listener.cancel()
+        try:
+            await self.listener
+        except asyncio.CancelledError:
+            pass
+        self.listener = None
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self.redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        self._invalidate(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                # Invalidations may be lost meanwhile, stale items live until ttl
+                logger.error("Locale invalidation listener failed: %s", ex)
+                await asyncio.sleep(1)
+
+    def _invalidate(self, data: bytes | str) -> None:
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        instance_id, _, message = data.partition(":")
+        if instance_id == self.instance_id:
+            return
+        try:
+            key = StorageKey(**json.loads(message))
+        except (ValueError, TypeError) as ex:
+            logger.error("Bad locale invalidation %r: %s", data, ex)
+            return
+        self.memory.delete(key)
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.memory.stats(), "invalidations": self.invalidations}
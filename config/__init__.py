@@ -1,4 +1,11 @@
 from .config import config
-from .config import AppMode
+from .config import AppMode, ConversionMode, ExecutorMode, ProgressMode, RunMode
 
-__all__ = ["config", "AppMode"]
+__all__ = [
+    "config",
+    "AppMode",
+    "ConversionMode",
+    "ExecutorMode",
+    "ProgressMode",
+    "RunMode",
+]
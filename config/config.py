@@ -10,8 +10,36 @@ class AppMode(str, Enum):
     PROD = "prod"
 
 
+class RunMode(str, Enum):
+    POLLING = "polling"
+    WEBHOOK = "webhook"
+
+
+class ProgressMode(str, Enum):
+    MESSAGE = "message"
+    CHAT_ACTION = "chat_action"
+
+
+class ConversionMode(str, Enum):
+    INLINE = "inline"
+    QUEUE = "queue"
+
+
+class ExecutorMode(str, Enum):
+    THREAD = "thread"
+    PROCESS = "process"
+
+
 class Config(BaseSettings):
     APP_MODE: AppMode = AppMode.DEV
+    RUN_MODE: RunMode = RunMode.POLLING
+
+    WEBHOOK_URL: str | None = None
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_SECRET: str | None = None
+    WEBHOOK_WORKERS: int = 2
 
     BOT_TOKEN: str
     BOT_ADMIN_CHAT_ID: List[str] | None
@@ -19,10 +47,93 @@ class Config(BaseSettings):
     REDIS_HOST: str = "tg-to-md-bot-redis"
     REDIS_PASSWORD: str | None
 
+    MEDIA_DOWNLOAD_CONCURRENCY: int = 4
+    MEDIA_DOWNLOAD_GLOBAL_CONCURRENCY: int = 32
+
+    MEDIA_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    MEDIA_CACHE_TTL: int = 24 * 60 * 60
+    # Media in the FSM Redis, off by default: size it first, see README
+    MEDIA_CACHE_REDIS: bool = False
+    MEDIA_CACHE_REDIS_MAX_ITEM_BYTES: int = 512 * 1024
+    MEDIA_CACHE_REDIS_MAX_BYTES: int = 256 * 1024 * 1024
+
+    MEMORY_BUDGET_BYTES: int = 256 * 1024 * 1024
+    MEDIA_SPILL_THRESHOLD: int = 8 * 1024 * 1024
+    SPILL_DIR: str | None = None
+
+    IMAGE_COMPACT_SIDE: int = 1280
+    IMAGE_COMPACT_BYTES: int = 300 * 1024
+    IMAGE_PREVIEW_SIDE: int = 640
+    IMAGE_PREVIEW_BYTES: int = 80 * 1024
+    IMAGE_QUALITY: int = 80
+    IMAGE_FORMAT: str = "jpeg"
+    IMAGE_WORKERS: int = 2
+
+    CONVERSION_EXECUTOR: ExecutorMode = ExecutorMode.THREAD
+    CONVERSION_WORKERS: int = 4
+    # Total length of the parsed messages, Telegram texts are up to 4096 characters
+    PARSE_OFFLOAD_MIN_CHARS: int = 2000
+    ENCODE_OFFLOAD_MIN_BYTES: int = 512 * 1024
+
+    CONVERSION_CACHE_SIZE: int = 10000
+    CONVERSION_CACHE_TTL: int = 7 * 24 * 60 * 60
+    CONVERSION_CACHE_REDIS: bool = True
+
+    PROGRESS_MODE: ProgressMode = ProgressMode.MESSAGE
+    PROGRESS_DELAY: float = 1.0
+    PROGRESS_INTERVAL: float = 1.0
+    PROGRESS_MAX_CALLS_PER_TICK: int = 10
+
+    CONVERSION_MODE: ConversionMode = ConversionMode.INLINE
+    JOB_STREAM: str = "conversion:jobs"
+    JOB_DEAD_LETTER_STREAM: str = "conversion:jobs:dead"
+    JOB_GROUP: str = "converters"
+    JOB_MAX_RETRIES: int = 3
+    JOB_VISIBILITY_TIMEOUT: float = 5 * 60
+    JOB_DEAD_LETTER_MAX_LEN: int = 100000
+    JOB_WORKER_CONCURRENCY: int = 8
+
+    API_GLOBAL_RATE: float = 30.0
+    API_GLOBAL_BURST: int = 30
+    API_CHAT_RATE: float = 1.0
+    API_CHAT_BURST: int = 3
+    API_GROUP_RATE: float = 20 / 60
+    API_MAX_RETRIES: int = 2
+
+    SCHEDULER_WORKERS: int = 16
+    SCHEDULER_MAX_QUEUE_PER_USER: int = 5
+
+    LOCALE_CACHE_SIZE: int = 100000
+    LOCALE_CACHE_TTL: int = 60 * 60
+
+    BATCH_MAX_MESSAGES: int = 500
+    BATCH_TTL: int = 24 * 60 * 60
+
+    ALBUM_DEBOUNCE: float = 0.5
+    ALBUM_MAX_WAIT: float = 3.0
+
+    STARTUP_CACHE_DIR: str = ".cache"
+    COMMANDS_CHECK_INTERVAL: int = 24 * 60 * 60
+
+    METRICS_ENABLED: bool = True
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 9090
+    LOOP_LAG_INTERVAL: float = 0.5
+    LOOP_STALL_THRESHOLD: float = 0.1
+
+    PROFILE_DIR: str = "profiles"
+    PROFILE_DEFAULT_REQUESTS: int = 20
+    PROFILE_MAX_SECONDS: float = 60.0
+    PROFILE_TRACEMALLOC_FRAMES: int = 10
+
     LOG_LEVEL: int | str = logging.INFO
     LOV_FORMAT: str = (
         "%(asctime)s - %(name)s - %(levelname)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s"
     )
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_USER_RATE: float = 5.0
+    LOG_USER_BURST: int = 20
+    LOG_SAMPLE_RATE: float = 1.0
 
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
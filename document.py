@@ -0,0 +1,291 @@
+import base64
+import io
+import tempfile
+import zipfile
+from abc import abstractmethod
+from enum import Enum
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Dict, List, Tuple
+
+import aiofiles
+from aiogram import Bot
+from aiogram.types import InputFile
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE
+
+from spill import SpillScope
+
+if TYPE_CHECKING:
+    from executor import ConversionExecutor
+
+PHOTO_LINK_PREFIX = b"\n\n![TG_PHOTO](data:image/jpeg;base64,"
+PHOTO_LINK_SUFFIX = b")"
+
+# Image type -> file extension, photos are JPEG unless recompressed to WebP
+IMAGE_EXTENSIONS = {"jpeg": "jpg", "webp": "webp"}
+
+# Markdown horizontal rule between the messages of the single document
+MESSAGE_SEPARATOR = "\n\n---\n\n"
+
+# Raw bytes encoded by the single pool task, a multiple of 3 so the blocks join cleanly
+ENCODE_BLOCK_SIZE = 3 * 2**19
+
+# Photo content in memory or the temp file it was spilled to
+Photo = bytes | memoryview | Path
+
+
+def image_type(photo: Photo) -> str:
+    """
+    Image type of the photo by its signature
+    :param photo: Photo content or its temp file
+    :return: "webp" or "jpeg"
+    """
+    if isinstance(photo, Path):
+        with photo.open("rb") as file:
+            header = file.read(12)
+    else:
+        header = bytes(photo[:12])
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return "jpeg"
+
+
+def photo_link_prefix(photo: Photo) -> bytes:
+    return PHOTO_LINK_PREFIX.replace(b"jpeg", image_type(photo).encode("ascii"))
+
+
+class OutputMode(str, Enum):
+    MARKDOWN = "md"
+    ZIP = "zip"
+
+
+class Document(InputFile):
+    """
+    Converted message uploaded to the user.\r\n
+    Used as a context manager, memory reservations and temp files of the document
+    are released on exit.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        spill: SpillScope | None = None,
+    ):
+        """
+        :param filename: File name for the user
+        :param chunk_size: Upload chunk size
+        :param spill: Memory budget and temp files of the conversion, None - keep all in memory
+        """
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.spill = spill
+
+    def __enter__(self) -> "Document":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.cleanup()
+
+    def cleanup(self) -> None:
+        """
+        Release memory reservations and remove temp files of the document
+        """
+        if self.spill is not None:
+            self.spill.close()
+
+    @abstractmethod
+    def add_text(self, text: str) -> None:
+        """
+        Append markdown text to the document
+        :param text: Markdown text
+        """
+
+    @abstractmethod
+    def add_photo(self, index: int, photo: Photo) -> None:
+        """
+        Append photo to the document in the document order
+        :param index: Photo index in the message
+        :param photo: Raw photo content or its temp file
+        """
+
+    def store_photo(self, index: int, photo: Photo) -> None:
+        """
+        Called as soon as the photo is downloaded, before it is added in the document order
+        :param index: Photo index in the message
+        :param photo: Raw photo content or its temp file
+        """
+
+    @property
+    @abstractmethod
+    def size(self) -> int:
+        """
+        Size of the uploaded file in bytes
+        """
+
+
+class MarkdownDocument(Document):
+    """
+    Markdown document uploaded as a stream of byte chunks.\r\n
+    Text parts are stored encoded, photos are stored as downloaded and base64 encoded
+    piece by piece straight into the upload, so the whole document never exists in memory.
+    Spilled photos are read from their temp files while uploading.
+    Large photos are encoded in the executor pool by big blocks instead.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        spill: SpillScope | None = None,
+        executor: "ConversionExecutor | None" = None,
+    ):
+        """
+        :param executor: Pool for base64 of large photos, None - encode on the event loop
+        """
+        super().__init__(filename=filename, chunk_size=chunk_size, spill=spill)
+        self.executor = executor
+        # (is photo, content) in the document order, photo link text is stored as text parts
+        self.parts: List[Tuple[bool, Photo]] = []
+
+    def add_text(self, text: str) -> None:
+        if text:
+            self.parts.append((False, text.encode(encoding="utf-8")))
+
+    def add_photo(self, index: int, photo: Photo) -> None:
+        self.parts.append((False, photo_link_prefix(photo)))
+        self.parts.append((True, photo))
+        self.parts.append((False, PHOTO_LINK_SUFFIX))
+
+    @property
+    def size(self) -> int:
+        """
+        Size of the document in bytes, without building it
+        """
+        size = 0
+        for is_photo, part in self.parts:
+            if is_photo:
+                length = part.stat().st_size if isinstance(part, Path) else len(part)
+                size += (length + 2) // 3 * 4
+            else:
+                size += len(part)
+        return size
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        # base64 of every 3 input bytes is 4 output bytes, keep raw chunks aligned
+        raw_chunk_size = max(self.chunk_size // 4 * 3, 3)
+        for is_photo, part in self.parts:
+            if not is_photo:
+                yield part
+                continue
+            length = part.stat().st_size if isinstance(part, Path) else len(part)
+            if self.executor is not None and self.executor.offloads(length):
+                block_size, encode = ENCODE_BLOCK_SIZE, self.executor.encode
+            else:
+                block_size, encode = raw_chunk_size, None
+            if isinstance(part, Path):
+                async with aiofiles.open(part, "rb") as file:
+                    while chunk := await file.read(block_size):
+                        yield await encode(chunk) if encode else base64.b64encode(chunk)
+            else:
+                view = memoryview(part)
+                for start in range(0, len(view), block_size):
+                    chunk = view[start : start + block_size]
+                    yield await encode(chunk) if encode else base64.b64encode(chunk)
+
+
+class ZipDocument(Document):
+    """
+    Zip archive with message.md and images/N.jpg files referenced from it.\r\n
+    Images are stored without compression and re-encoding as soon as they are downloaded,
+    markdown is written when the archive is uploaded. The archive is built in memory
+    until it exceeds the spill threshold or the memory budget, then it moves to a temp file.
+    """
+
+    markdown_name = "message.md"
+
+    def __init__(
+        self,
+        filename: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        spill: SpillScope | None = None,
+    ):
+        super().__init__(filename=filename, chunk_size=chunk_size, spill=spill)
+        self.buffer = tempfile.SpooledTemporaryFile(
+            max_size=spill.threshold if spill else 0,
+            dir=spill.directory if spill else None,
+        )
+        self.archive = zipfile.ZipFile(self.buffer, "w")
+        self.markdown: List[str] = []
+        # photo index -> name in the archive
+        self.stored: Dict[int, str] = {}
+
+    @staticmethod
+    def photo_name(index: int, photo: Photo) -> str:
+        return f"images/{index + 1}.{IMAGE_EXTENSIONS[image_type(photo)]}"
+
+    def add_text(self, text: str) -> None:
+        self.markdown.append(text)
+
+    def add_photo(self, index: int, photo: Photo) -> None:
+        self.store_photo(index, photo)
+        self.markdown.append(f"\n\n![TG_PHOTO]({self.stored[index]})")
+
+    def store_photo(self, index: int, photo: Photo) -> None:
+        if index in self.stored:
+            return
+        length = photo.stat().st_size if isinstance(photo, Path) else len(photo)
+        if self.spill is not None and not self.spill.reserve(length):
+            self.buffer.rollover()
+        name = self.photo_name(index, photo)
+        if isinstance(photo, Path):
+            self.archive.write(photo, name, compress_type=zipfile.ZIP_STORED)
+        else:
+            self.archive.writestr(name, photo, compress_type=zipfile.ZIP_STORED)
+        self.stored[index] = name
+
+    def close(self) -> None:
+        """
+        Write markdown and finish the archive, no more parts can be added after
+        """
+        if self.archive.fp is None:
+            return
+        self.archive.writestr(
+            self.markdown_name,
+            "".join(self.markdown),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        self.archive.close()
+
+    def cleanup(self) -> None:
+        self.archive.close()
+        self.buffer.close()
+        super().cleanup()
+
+    @property
+    def size(self) -> int:
+        self.close()
+        return self.buffer.seek(0, io.SEEK_END)
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        self.close()
+        self.buffer.seek(0)
+        while chunk := self.buffer.read(self.chunk_size):
+            yield chunk
+
+
+def create_document(
+    output_mode: OutputMode | str,
+    name: str,
+    spill: SpillScope | None = None,
+    executor: "ConversionExecutor | None" = None,
+) -> Document:
+    """
+    Create empty document for the user output mode
+    :param output_mode: User output mode
+    :param name: File name without extension
+    :param spill: Memory budget and temp files of the conversion, None - keep all in memory
+    :param executor: Pool for base64 of large photos, zip stores photos as is and needs none
+    :return: Document
+    """
+    if output_mode == OutputMode.ZIP:
+        return ZipDocument(filename=f"{name}.zip", spill=spill)
+    return MarkdownDocument(filename=f"{name}.md", spill=spill, executor=executor)
@@ -0,0 +1,131 @@
+import asyncio
+import base64
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+from aiogram.types import MessageEntity
+
+from config import ExecutorMode
+from utils import parse_html_to_md
+
+
+# (text, entities) of the single message
+ParseItem = Tuple[str | None, List[MessageEntity] | None]
+
+
+def parse_plain(items: List[Tuple[str | None, List[Dict[str, Any]]]]) -> List[str]:
+    """
+    Process pool task: parse_html_to_md of the messages with the entities as dicts.
+    Entities of the received messages are bound to the bot, they can't be pickled.
+    :param items: (text, entity dicts) of the messages
+    :return: Markdown of the messages
+    """
+    return [
+        parse_html_to_md(text, [MessageEntity(**entity) for entity in entities])
+        for text, entities in items
+    ]
+
+
+def parse_items(items: List[ParseItem]) -> List[str]:
+    return [parse_html_to_md(text, entities) for text, entities in items]
+
+
+class ConversionExecutor:
+    """
+    Runs CPU-bound conversion steps of large messages and photos in a pool.\r\n
+    Small work stays on the event loop: handing it to the pool costs more than doing it.
+    Threads keep the loop responsive between the steps, processes also run the steps
+    in parallel, but the work is copied to them.
+    """
+
+    def __init__(
+        self,
+        mode: ExecutorMode,
+        workers: int,
+        parse_min_chars: int,
+        encode_min_bytes: int,
+    ):
+        """
+        :param mode: Thread or process pool
+        :param workers: Pool size
+        :param parse_min_chars: Texts of this length and longer are parsed in the pool
+        :param encode_min_bytes: Photos of this size and larger are base64 encoded in the pool
+        """
+        self.mode = mode
+        self.workers = workers
+        self.parse_min_chars = parse_min_chars
+        self.encode_min_bytes = encode_min_bytes
+        self.pool: Executor | None = None
+        self.parsed = 0
+        self.encoded = 0
+        self.encoded_bytes = 0
+
+    def _pool(self) -> Executor:
+        if self.pool is None:
+            if self.mode == ExecutorMode.PROCESS:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self.pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="conversion"
+                )
+        return self.pool
+
+    async def parse(
+        self, text: str | None, entities: List[MessageEntity] | None
+    ) -> str:
+        """
+        parse_html_to_md, in the pool for long texts
+        """
+        return (await self.parse_many([(text, entities)]))[0]
+
+    async def parse_many(self, items: List[ParseItem]) -> List[str]:
+        """
+        parse_html_to_md of the messages, in the pool by a single task if their
+        total length reaches the threshold, e.g. a batch of many short messages
+        :param items: (text, entities) of the messages
+        :return: Markdown of the messages
+        """
+        if sum(len(text or "") for text, _ in items) < self.parse_min_chars:
+            return parse_items(items)
+        self.parsed += len(items)
+        loop = asyncio.get_running_loop()
+        if self.mode == ExecutorMode.PROCESS:
+            plain = [
+                (
+                    text,
+                    [entity.model_dump(exclude_none=True) for entity in entities or ()],
+                )
+                for text, entities in items
+            ]
+            return await loop.run_in_executor(self._pool(), parse_plain, plain)
+        return await loop.run_in_executor(self._pool(), parse_items, items)
+
+    def offloads(self, size: int) -> bool:
+        """
+        True if the photo of the size is encoded in the pool
+        """
+        return size >= self.encode_min_bytes
+
+    async def encode(self, data: bytes | memoryview) -> bytes:
+        """
+        base64 of the photo block in the pool
+        """
+        if self.mode == ExecutorMode.PROCESS:
+            # memoryview can't be sent to the other process
+            data = bytes(data)
+        self.encoded += 1
+        self.encoded_bytes += len(data)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._pool(), base64.b64encode, data
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "parsed": self.parsed,
+            "encoded": self.encoded,
+            "encoded_bytes": self.encoded_bytes,
+        }
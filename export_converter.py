@@ -0,0 +1,302 @@
+"""
+Offline converter of Telegram Desktop exports (result.json) to Markdown files.
+
+Run from the repository root:
+    python export_converter.py ChatExport/result.json output/
+    python export_converter.py ChatExport/result.json output/ --split day --workers 8
+"""
+
+import argparse
+import base64
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import groupby
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from aiogram.types import MessageEntity
+
+from document import MESSAGE_SEPARATOR, PHOTO_LINK_PREFIX, PHOTO_LINK_SUFFIX
+from utils import parse_html_to_md
+
+ExportMessage = Dict[str, Any]
+# (output file name, messages of the file)
+OutputFile = Tuple[str, List[ExportMessage]]
+
+MESSAGES_START = re.compile(r'"messages"\s*:\s*\[')
+READ_CHUNK_SIZE = 1024 * 1024
+MESSAGES_PER_TASK = 200
+
+# Export text entity type -> Bot API entity type, if they differ
+ENTITY_TYPES = {
+    "link": "url",
+    "mention_name": "text_mention",
+    "phone": "phone_number",
+}
+
+PHOTO_UNAVAILABLE = "\n\n*⚠️ Photo is unavailable*"
+
+
+def iter_messages(
+    path: Path, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[ExportMessage]:
+    """
+    Stream messages of the export one by one, the file is never loaded entirely
+    :param path: result.json path
+    :param chunk_size: Characters read at once
+    :return: Messages in the export order
+    """
+    decoder = json.JSONDecoder()
+    with path.open(encoding="utf-8") as file:
+        buffer = ""
+        while (match := MESSAGES_START.search(buffer)) is None:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            # Keep the tail, the key may be split between the chunks
+            buffer = buffer[-32:] + chunk
+        buffer = buffer[match.end() :]
+        position = 0
+        eof = False
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position == len(buffer):
+                    raise ValueError("Buffer is empty")
+                message, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise ValueError(f"Broken export at {path}") from None
+                # The message is split between the chunks, read more
+                chunk = file.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield message
+
+
+def export_text(text_entities: List[Dict[str, Any]]) -> Tuple[str, List[MessageEntity]]:
+    """
+    Join export text pieces into the message text with Bot API entities
+    :param text_entities: text_entities array of the exported message
+    :return: Text and entities with UTF-16 offsets
+    """
+    pieces = []
+    entities = []
+    offset = 0
+    for piece in text_entities:
+        text = piece.get("text", "")
+        length = len(text.encode("utf-16-le")) // 2
+        entity_type = piece.get("type", "plain")
+        if entity_type != "plain" and length:
+            entities.append(
+                MessageEntity(
+                    type=ENTITY_TYPES.get(entity_type, entity_type),
+                    offset=offset,
+                    length=length,
+                    url=piece.get("href"),
+                    language=piece.get("language"),
+                )
+            )
+        pieces.append(text)
+        offset += length
+    return "".join(pieces), entities
+
+
+def text_pieces(message: ExportMessage) -> List[Dict[str, Any]]:
+    """
+    Text pieces of the message, older exports have only "text" field
+    """
+    pieces = message.get("text_entities")
+    if pieces is not None:
+        return pieces
+    text = message.get("text") or ""
+    if isinstance(text, str):
+        return [{"type": "plain", "text": text}]
+    return [
+        piece if isinstance(piece, dict) else {"type": "plain", "text": piece}
+        for piece in text
+    ]
+
+
+def message_to_markdown(
+    message: ExportMessage, export_dir: Path, output_dir: Path, link_photos: bool
+) -> str:
+    """
+    Convert exported message the same way the bot converts messages
+    :param message: Exported message
+    :param export_dir: Directory of result.json, photo paths are relative to it
+    :param output_dir: Directory of the output files
+    :param link_photos: Link photo files instead of embedding them
+    :return: Markdown
+    """
+    text, entities = export_text(text_pieces(message))
+    markdown = parse_html_to_md(text, entities)
+    photo = message.get("photo")
+    if not photo:
+        return markdown
+    photo_path = export_dir / photo
+    if not photo_path.is_file():
+        # Export made without photos has a note instead of the path
+        return markdown + PHOTO_UNAVAILABLE
+    if link_photos:
+        link = Path(os.path.relpath(photo_path, output_dir)).as_posix()
+        return f"{markdown}\n\n![TG_PHOTO]({link})"
+    encoded = base64.b64encode(photo_path.read_bytes())
+    return markdown + (PHOTO_LINK_PREFIX + encoded + PHOTO_LINK_SUFFIX).decode("ascii")
+
+
+def convert_files(
+    files: List[OutputFile], export_dir: Path, output_dir: Path, link_photos: bool
+) -> Tuple[int, int]:
+    """
+    Worker process task: convert messages and write the output files
+    :return: Messages count, bytes written
+    """
+    messages_count = 0
+    bytes_written = 0
+    for name, messages in files:
+        content = MESSAGE_SEPARATOR.join(
+            message_to_markdown(message, export_dir, output_dir, link_photos)
+            for message in messages
+        ).encode("utf-8")
+        (output_dir / name).write_bytes(content)
+        messages_count += len(messages)
+        bytes_written += len(content)
+    return messages_count, bytes_written
+
+
+def is_convertible(message: ExportMessage) -> bool:
+    return message.get("type") == "message" and bool(
+        message.get("text") or message.get("photo")
+    )
+
+
+def iter_tasks(
+    messages: Iterator[ExportMessage], split: str
+) -> Iterator[List[OutputFile]]:
+    """
+    Group messages into output files and the files into pool tasks
+    :param messages: Exported messages
+    :param split: "message" - file per message, "day" - file per day
+    :return: Files of each task
+    """
+    messages = filter(is_convertible, messages)
+    if split == "day":
+        # Export is chronological, so messages of the day are consecutive
+        for day, day_messages in groupby(
+            messages, key=lambda message: message["date"][:10]
+        ):
+            yield [(f"{day}.md", list(day_messages))]
+        return
+    task = []
+    for message in messages:
+        task.append((f"{message['id']}.md", [message]))
+        if len(task) == MESSAGES_PER_TASK:
+            yield task
+            task = []
+    if task:
+        yield task
+
+
+class Progress:
+    """
+    Converted messages and throughput, printed not more often than interval
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.started_at = time.perf_counter()
+        self.printed_at = self.started_at
+        self.messages = 0
+        self.bytes = 0
+
+    def add(self, messages: int, bytes_written: int) -> None:
+        self.messages += messages
+        self.bytes += bytes_written
+        now = time.perf_counter()
+        if now - self.printed_at >= self.interval:
+            self.printed_at = now
+            self.print()
+
+    def print(self) -> None:
+        elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+        print(
+            f"{self.messages} messages, {self.bytes / 2 ** 20:.1f} MiB in {elapsed:.1f} s"
+            f" ({self.messages / elapsed:.0f} msg/s, {self.bytes / 2 ** 20 / elapsed:.1f} MiB/s)",
+            file=sys.stderr,
+        )
+
+
+def convert_export(
+    export_path: Path,
+    output_dir: Path,
+    split: str = "message",
+    workers: int | None = None,
+    link_photos: bool = False,
+) -> Progress:
+    """
+    Convert the whole export in the process pool
+    :param export_path: result.json path
+    :param output_dir: Directory of the output files
+    :param split: "message" - file per message, "day" - file per day
+    :param workers: Pool size, CPU count by default
+    :param link_photos: Link photo files instead of embedding them
+    :return: Final progress
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    export_dir = export_path.parent.resolve()
+    output_dir = output_dir.resolve()
+    workers = workers or os.cpu_count() or 1
+    progress = Progress()
+    pending: Set[Future] = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for files in iter_tasks(iter_messages(export_path), split):
+            # Bounded queue of tasks, the reader does not run ahead of the pool
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    progress.add(*future.result())
+            pending.add(
+                executor.submit(
+                    convert_files, files, export_dir, output_dir, link_photos
+                )
+            )
+        for future in wait(pending).done:
+            progress.add(*future.result())
+    progress.print()
+    return progress
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "export", type=Path, help="result.json of Telegram Desktop export"
+    )
+    parser.add_argument("output", type=Path, help="Output directory")
+    parser.add_argument(
+        "--split",
+        choices=("message", "day"),
+        default="message",
+        help="Markdown file per message or per day",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Processes count")
+    parser.add_argument(
+        "--link-photos",
+        action="store_true",
+        help="Link photos of the export instead of embedding them as base64",
+    )
+    args = parser.parse_args()
+    convert_export(args.export, args.output, args.split, args.workers, args.link_photos)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import builtins
+import hashlib
+import logging
+import marshal
+import pickle
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import babel
+import babel.plural
+import fluent_compiler
+from aiogram_i18n.cores import FluentCompileCore
+from fluent_compiler import compiler, runtime
+from fluent_compiler.resource import FtlResource
+
+logger = logging.getLogger(__name__)
+
+# The cache keeps the bytecode of the code generated by the compiler, so changes of
+# the cache format, of the Python version or of the compiler version invalidate it
+CACHE_VERSION = (
+    f"2:{tuple(sys.version_info)}:{getattr(fluent_compiler, '__version__', None)}"
+)
+
+
+class CompiledBundle:
+    """
+    Translations of the single locale compiled to the Python functions,
+    formats messages the same way as fluent_compiler FluentBundle
+    """
+
+    def __init__(self, locale: str, messages: Dict[str, Callable[..., str]]):
+        self.locale = locale
+        self.messages = messages
+
+    def has_message(self, message_id: str) -> bool:
+        return message_id in self.messages
+
+    def format(
+        self, message_id: str, args: Dict[str, Any] | None = None
+    ) -> Tuple[str, List[Exception]]:
+        errors = []
+        return self.messages[message_id](args, errors), errors
+
+
+class CachedFluentCompileCore(FluentCompileCore):
+    """
+    FluentCompileCore which keeps the compiled bundles on disk.\r\n
+    Generating the Python code from .ftl files takes most of the compile time,
+    so the code objects are stored and reused until any .ftl file of the locale changes.
+    """
+
+    def __init__(self, path: str | Path, cache_dir: str | Path, **kwargs: Any):
+        """
+        :param path: Locales path with {locale} placeholder
+        :param cache_dir: Directory for the compiled bundles
+        :param kwargs: FluentCompileCore params
+        """
+        super().__init__(path=path, **kwargs)
+        self.cache_dir = Path(cache_dir)
+        self.compile_time = 0.0
+
+    async def startup(self) -> None:
+        # Locales may be loaded before the dispatcher startup to time the boot
+        if not self.locales:
+            await super().startup()
+
+    def find_locales(self) -> Dict[str, CompiledBundle]:
+        started_at = time.perf_counter()
+        translations = {}
+        locales = self._extract_locales(self.path)
+        for locale, paths in self._find_locales(self.path, locales, ".ftl").items():
+            texts = [path.read_text(encoding="utf8") for path in sorted(paths)]
+            translations[locale] = self.load_bundle(locale, "\n".join(texts))
+        self.compile_time = time.perf_counter() - started_at
+        return translations
+
+    def load_bundle(self, locale: str, text: str) -> CompiledBundle:
+        """
+        Load compiled bundle from the cache or compile and cache it
+        :param locale: Locale name
+        :param text: Joined .ftl files of the locale
+        :return: Bundle
+        """
+        digest = hashlib.sha256(
+            f"{CACHE_VERSION}:{self.use_isolating}:{sorted(self.functions)}\0{text}".encode(
+                "utf-8"
+            )
+        ).hexdigest()
+        cache_path = self.cache_dir / f"{locale}-{digest[:16]}.bin"
+        try:
+            cached_digest, code, mapping, function_names = pickle.loads(
+                cache_path.read_bytes()
+            )
+            if cached_digest == digest:
+                return self._bundle(
+                    locale, marshal.loads(code), mapping, function_names
+                )
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            logger.warning("Cannot load compiled locale %s: %s", locale, ex)
+
+        compiled = compiler.compile_messages(
+            locale,
+            [FtlResource.from_string(text)],
+            use_isolating=self.use_isolating,
+            functions=self.functions,
+        )
+        if compiled.errors:
+            for message_id, error in compiled.errors:
+                logger.warning("Locale %s, message %s: %s", locale, message_id, error)
+            # Not cached, so errors are reported on each start until fixed
+            return CompiledBundle(locale, compiled.message_functions)
+
+        code = compile(compiled.module_ast, f"<locale {locale}>", "exec")
+        mapping = {
+            message_id: function.__name__
+            for message_id, function in compiled.message_functions.items()
+        }
+        module_globals = next(iter(compiled.message_functions.values()), None)
+        module_globals = module_globals.__globals__ if module_globals else {}
+        function_names = {
+            name: original_name
+            for original_name, function in self.functions.items()
+            for name, value in module_globals.items()
+            if value is function
+        }
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            temp_path = cache_path.with_suffix(".tmp")
+            temp_path.write_bytes(
+                pickle.dumps((digest, marshal.dumps(code), mapping, function_names))
+            )
+            temp_path.replace(cache_path)
+            for old_path in self.cache_dir.glob(f"{locale}-*.bin"):
+                if old_path != cache_path:
+                    old_path.unlink(missing_ok=True)
+        except OSError as ex:
+            logger.warning("Cannot cache compiled locale %s: %s", locale, ex)
+        return CompiledBundle(locale, compiled.message_functions)
+
+    def _bundle(
+        self,
+        locale: str,
+        code: Any,
+        mapping: Dict[str, str],
+        function_names: Dict[str, str],
+    ) -> CompiledBundle:
+        # The same globals fluent_compiler gives to the generated module
+        babel_locale = babel.Locale.parse(locale.replace("-", "_"))
+        plural_form_for_number_main = babel.plural.to_python(babel_locale.plural_form)
+
+        def plural_form_for_number(number):
+            try:
+                return plural_form_for_number_main(number)
+            except TypeError:
+                return None
+
+        module_globals = {name: getattr(runtime, name) for name in runtime.__all__}
+        module_globals.update(builtins.__dict__)
+        module_globals[compiler.LOCALE_NAME] = babel_locale
+        module_globals[compiler.PLURAL_FORM_FOR_NUMBER_NAME] = plural_form_for_number
+        for name, original_name in function_names.items():
+            module_globals[name] = self.functions[original_name]
+        exec(code, module_globals)
+        return CompiledBundle(
+            locale,
+            {message_id: module_globals[name] for message_id, name in mapping.items()},
+        )
+
+
+if __name__ == "__main__":
+    # Precompile on image build: python fluent_cache.py [locales path] [cache dir]
+    import asyncio
+
+    logging.basicConfig(level=logging.INFO)
+    core = CachedFluentCompileCore(
+        path=sys.argv[1] if len(sys.argv) > 1 else "locales/{locale}/LC_MESSAGES",
+        cache_dir=sys.argv[2] if len(sys.argv) > 2 else ".cache/locales",
+    )
+    asyncio.run(core.startup())
+    logger.info("Compiled %s in %.3f s", ", ".join(core.locales), core.compile_time)
@@ -0,0 +1,161 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from aiogram.types import PhotoSize
+
+from config import config
+from document import Photo
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is in requirements.txt, without it (e.g. a partial dev install) photos
+    # are only selected by size, not recompressed
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+class ImagePolicy(str, Enum):
+    ORIGINAL = "original"
+    COMPACT = "compact"
+    PREVIEW = "preview"
+
+
+def policy_limits(policy: ImagePolicy | str) -> Tuple[int, int] | None:
+    """
+    :param policy: User image policy
+    :return: Target max side in pixels and max bytes of the photo, None - keep the original
+    """
+    if policy == ImagePolicy.COMPACT:
+        return config.IMAGE_COMPACT_SIDE, config.IMAGE_COMPACT_BYTES
+    if policy == ImagePolicy.PREVIEW:
+        return config.IMAGE_PREVIEW_SIDE, config.IMAGE_PREVIEW_BYTES
+    return None
+
+
+def select_photo(
+    sizes: List[PhotoSize], policy: ImagePolicy | str = ImagePolicy.ORIGINAL
+) -> PhotoSize:
+    """
+    Choose the size of the photo to download
+    :param sizes: Available sizes of the photo, as in Message.photo
+    :param policy: User image policy
+    :return: The smallest size reaching the target side, the largest for the original policy
+    """
+    limits = policy_limits(policy)
+    if limits is None:
+        return sizes[-1]
+    max_side, max_bytes = limits
+    sizes = sorted(sizes, key=lambda size: size.width * size.height)
+    photo = next(
+        (size for size in sizes if max(size.width, size.height) >= max_side),
+        sizes[-1],
+    )
+    if Image is None and photo.file_size and photo.file_size > max_bytes:
+        # It can't be recompressed, a smaller size within the budget is better
+        photo = next(
+            (
+                size
+                for size in reversed(sizes)
+                if size.file_size and size.file_size <= max_bytes
+            ),
+            photo,
+        )
+    return photo
+
+
+def recompress(
+    source: bytes | str, max_side: int, quality: int, image_format: str
+) -> bytes:
+    """
+    Process pool task: downscale and re-encode the photo
+    :param source: Photo content or its file path
+    :param max_side: Max width and height
+    :param quality: Encoder quality, 1-100
+    :param image_format: "jpeg" or "webp"
+    :return: Encoded photo
+    """
+    with Image.open(
+        io.BytesIO(source) if isinstance(source, bytes) else source
+    ) as image:
+        image.thumbnail((max_side, max_side))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format=image_format.upper(), quality=quality)
+        return output.getvalue()
+
+
+class ImageProcessor:
+    """
+    Downscales and re-encodes photos exceeding the policy limits in the process pool,
+    so the event loop is not blocked by the image codecs
+    """
+
+    def __init__(self, workers: int, quality: int, image_format: str):
+        """
+        :param workers: Pool processes, started on the first photo
+        :param quality: Encoder quality, 1-100
+        :param image_format: "jpeg" or "webp"
+        """
+        self.workers = workers
+        self.quality = quality
+        self.image_format = image_format
+        self.pool: ProcessPoolExecutor | None = None
+        self.recompressed = 0
+        self.saved_bytes = 0
+        self.errors = 0
+
+    async def process(
+        self, photo: Photo, size: PhotoSize, policy: ImagePolicy | str
+    ) -> Photo:
+        """
+        :param photo: Downloaded photo
+        :param size: Downloaded photo size
+        :param policy: User image policy
+        :return: Recompressed photo, the same photo if it fits the policy or can't be smaller
+        """
+        limits = policy_limits(policy)
+        if limits is None or Image is None:
+            return photo
+        max_side, max_bytes = limits
+        length = photo.stat().st_size if isinstance(photo, Path) else len(photo)
+        if length <= max_bytes and max(size.width, size.height) <= max_side:
+            return photo
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        source = str(photo) if isinstance(photo, Path) else bytes(photo)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.pool, recompress, source, max_side, self.quality, self.image_format
+            )
+        except Exception as ex:
+            logger.error("Cannot recompress photo %s: %s", size.file_id, ex)
+            self.errors += 1
+            if isinstance(ex, BrokenProcessPool):
+                # Worker died, e.g. killed on out of memory, next photos get a new pool
+                self.pool = None
+            return photo
+        if len(result) >= length:
+            return photo
+        self.recompressed += 1
+        self.saved_bytes += length - len(result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "recompressed": self.recompressed,
+            "saved_bytes": self.saved_bytes,
+            "errors": self.errors,
+        }
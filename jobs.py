@@ -0,0 +1,276 @@
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+logger = logging.getLogger(__name__)
+
+# Job: {"chat_id", "locale", "output_mode", "entries", "cache_key"}
+# entries are batch entries, see batch.pack_message
+ConversionJob = Dict[str, Any]
+JobHandler = Callable[[ConversionJob], Awaitable[None]]
+DeadLetterHandler = Callable[[ConversionJob, str], Awaitable[None]]
+
+
+class JobQueue:
+    """
+    Durable conversion jobs in the Redis stream.\r\n
+    Handlers enqueue jobs, worker processes of any node read them with the consumer group.
+    A job is acknowledged when its handler finishes. A failed job is added again with
+    the next attempt number until max_retries, then it goes to the dead-letter stream.
+    A running job keeps its entry fresh with a heartbeat. Jobs of the crashed workers
+    stay pending and are claimed by the others after the visibility timeout, the claim
+    counts as a failed attempt. The jobs stream is never trimmed, acknowledged entries
+    are deleted, so it holds the pending and unread jobs only.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        stream: str,
+        group: str,
+        dead_letter_stream: str,
+        max_retries: int = 3,
+        visibility_timeout: float = 300,
+        max_len: int = 100000,
+    ):
+        """
+        :param redis: Redis client
+        :param stream: Jobs stream key
+        :param group: Consumer group of the workers
+        :param dead_letter_stream: Stream of the jobs failed max_retries times
+        :param max_retries: Retries of the failed job
+        :param visibility_timeout: Seconds the job may stay unacknowledged before it is claimed by other worker
+        :param max_len: Approximate max length of the dead-letter stream
+        """
+        self.redis = redis
+        self.stream = stream
+        self.group = group
+        self.dead_letter_stream = dead_letter_stream
+        self.max_retries = max_retries
+        self.visibility_timeout = visibility_timeout
+        self.max_len = max_len
+        self.running = False
+        self.enqueued = 0
+        self.done = 0
+        self.retried = 0
+        self.claimed = 0
+        self.dead = 0
+        self.in_flight = 0
+
+    async def enqueue(self, job: ConversionJob) -> str:
+        """
+        :param job: Conversion job
+        :return: Stream entry id
+        """
+        entry_id = await self.redis.xadd(
+            self.stream, {"job": json.dumps(job, ensure_ascii=False), "attempt": 0}
+        )
+        self.enqueued += 1
+        return entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+
+    async def create_group(self) -> None:
+        try:
+            await self.redis.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as ex:
+            if "BUSYGROUP" not in str(ex):
+                raise
+
+    async def consume(
+        self,
+        consumer: str,
+        handler: JobHandler,
+        on_dead_letter: DeadLetterHandler | None = None,
+        concurrency: int = 8,
+        block: float = 5,
+    ) -> None:
+        """
+        Handle jobs until stop() is called, then wait for the jobs in progress
+        :param consumer: Consumer name, unique within the group
+        :param handler: Job handler, an exception means the job failed
+        :param on_dead_letter: Called with the job and the error when the job is dead-lettered
+        :param concurrency: Max jobs handled at once
+        :param block: Seconds to wait for the new jobs
+        :return:
+        """
+        await self.create_group()
+        self.running = True
+        tasks: Set[asyncio.Task] = set()
+        try:
+            while self.running:
+                if len(tasks) >= concurrency:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                try:
+                    entries, claimed = await self._read(
+                        consumer, concurrency - len(tasks), block
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    logger.error("Cannot read jobs: %s", ex)
+                    await asyncio.sleep(1)
+                    continue
+                for entry_id, fields in entries:
+                    task = asyncio.create_task(
+                        self._handle(
+                            consumer, entry_id, fields, claimed, handler, on_dead_letter
+                        )
+                    )
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+
+    def stop(self) -> None:
+        self.running = False
+
+    async def _read(
+        self, consumer: str, count: int, block: float
+    ) -> Tuple[List[Tuple[str, Dict[str, str]]], bool]:
+        """
+        Jobs abandoned by the crashed workers first, then the new ones
+        :return: Entries and True if they are claimed
+        """
+        _, claimed, _ = await self.redis.xautoclaim(
+            self.stream,
+            self.group,
+            consumer,
+            min_idle_time=int(self.visibility_timeout * 1000),
+            count=count,
+        )
+        # Entries deleted from the stream come without fields
+        entries = [entry for entry in claimed if entry[1]]
+        self.claimed += len(entries)
+        is_claimed = bool(entries)
+        if not is_claimed:
+            response = await self.redis.xreadgroup(
+                self.group,
+                consumer,
+                {self.stream: ">"},
+                count=count,
+                block=int(block * 1000),
+            )
+            entries = response[0][1] if response else []
+        decoded = [
+            (
+                self._decode(entry_id),
+                {
+                    self._decode(key): self._decode(value)
+                    for key, value in fields.items()
+                },
+            )
+            for entry_id, fields in entries
+        ]
+        return decoded, is_claimed
+
+    async def _handle(
+        self,
+        consumer: str,
+        entry_id: str,
+        fields: Dict[str, str],
+        claimed: bool,
+        handler: JobHandler,
+        on_dead_letter: DeadLetterHandler | None,
+    ) -> None:
+        self.in_flight += 1
+        try:
+            attempt = int(fields.get("attempt", 0))
+            if claimed:
+                # The previous delivery has not finished, it counts as a failed attempt.
+                # The job is added again with the next attempt number stored in Redis,
+                # so a job crashing its workers reaches the dead-letter stream.
+                await self._fail(
+                    entry_id, fields, attempt, "Job was not finished", on_dead_letter
+                )
+                return
+            job = json.loads(fields["job"])
+            heartbeat = asyncio.create_task(self._heartbeat(consumer, entry_id))
+            try:
+                await handler(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.error("Job %s attempt %s failed: %s", entry_id, attempt, ex)
+                await self._fail(entry_id, fields, attempt, repr(ex), on_dead_letter)
+                return
+            finally:
+                heartbeat.cancel()
+            await self._ack(entry_id)
+            self.done += 1
+        except asyncio.CancelledError:
+            # Left pending, claimed by other worker after the visibility timeout
+            raise
+        except Exception as ex:
+            logger.error("Job %s cannot be handled: %s", entry_id, ex)
+        finally:
+            self.in_flight -= 1
+
+    async def _fail(
+        self,
+        entry_id: str,
+        fields: Dict[str, str],
+        attempt: int,
+        error: str,
+        on_dead_letter: DeadLetterHandler | None,
+    ) -> None:
+        dead = attempt >= self.max_retries
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if dead:
+                pipe.xadd(
+                    self.dead_letter_stream,
+                    {**fields, "error": error, "entry_id": entry_id},
+                    maxlen=self.max_len,
+                    approximate=True,
+                )
+            else:
+                pipe.xadd(self.stream, {**fields, "attempt": attempt + 1})
+            pipe.xack(self.stream, self.group, entry_id)
+            pipe.xdel(self.stream, entry_id)
+            await pipe.execute()
+        if not dead:
+            self.retried += 1
+            return
+        self.dead += 1
+        if on_dead_letter is not None:
+            await on_dead_letter(json.loads(fields["job"]), error)
+
+    async def _heartbeat(self, consumer: str, entry_id: str) -> None:
+        """
+        Reset the idle time of the running job, so it is not claimed by other worker
+        """
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            try:
+                # JUSTID does not increase the delivery count
+                await self.redis.xclaim(
+                    self.stream, self.group, consumer, 0, [entry_id], justid=True
+                )
+            except Exception as ex:
+                logger.warning("Job %s heartbeat failed: %s", entry_id, ex)
+
+    async def _ack(self, entry_id: str) -> None:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xack(self.stream, self.group, entry_id)
+            pipe.xdel(self.stream, entry_id)
+            await pipe.execute()
+
+    @staticmethod
+    def _decode(value: bytes | str | int) -> str:
+        return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enqueued": self.enqueued,
+            "done": self.done,
+            "retried": self.retried,
+            "claimed": self.claimed,
+            "dead": self.dead,
+            "in_flight": self.in_flight,
+        }
@@ -20,6 +20,12 @@ help-message = <b>📄 Markdown Converter Bot</b>
     💡 <b>How to use?</b>
     Simply <b>forward</b> any post or message to the bot – and receive a <u>Markdown document</u> in return!
 
+    ⚙️ <b>Commands</b>
+    /format_md – a single Markdown file with embedded images
+    /format_zip – a zip archive with Markdown and separate image files
+    /images_original, /images_compact, /images_preview – original, reduced or preview-sized photos
+    /batch – collect several messages, then send /done to get them in a single file
+
     🚀 <i>Perfect for:</i>
     • 📝 Summarizing useful posts
     • 📚 Creating documentation
@@ -60,4 +66,26 @@ some-problem = 😱 Oops, something went wrong
 
 change-lang = You've successfully set the language to English 🇬🇧
 
-unsupported-message = This message type is not supported yet.
\ No newline at end of file
+unsupported-message = This message type is not supported yet.
+
+photo-unavailable = ⚠️ Photo is unavailable
+
+change-format-md = Now you will receive a single Markdown file with embedded images 📄
+
+change-format-zip = Now you will receive a zip archive with a Markdown file and separate images 🗜
+
+too-busy = ⏳ You have too many messages in progress. Wait for the files you already sent to be ready and try again.
+
+batch-started = 📚 Batch mode is on. Forward up to { $max_messages } messages and send /done to get them in a single file.
+
+batch-full = ⚠️ The batch is full: { $max_messages } messages. Send /done to get the file, next messages are skipped.
+
+batch-empty = The batch is empty, nothing to convert.
+
+batch-not-started = Send /batch first, then forward the messages and send /done.
+
+change-images-original = Now photos will be added in the original quality 🖼
+
+change-images-compact = Now photos will be reduced to a moderate size, the files get smaller 🗂
+
+change-images-preview = Now photos will be reduced to small previews, the files get much smaller 🔍
\ No newline at end of file
@@ -20,6 +20,12 @@ help-message = <b>📄 Markdown Converter Bot</b>
     💡 <b>Как использовать?</b>
     Просто <b>перешли</b> боту любой пост или сообщение – и получи <u>Markdown-документ</u> в ответ!
 
+    ⚙️ <b>Команды</b>
+    /format_md – один Markdown-файл со встроенными картинками
+    /format_zip – zip-архив с Markdown и отдельными файлами картинок
+    /images_original, /images_compact, /images_preview – фото в оригинале, уменьшенные или превью
+    /batch – собрать несколько сообщений, затем отправь /done, чтобы получить их одним файлом
+
     🚀 <i>Идеально для:</i>
     • 📝 Конспектирования полезных постов
     • 📚 Создания документации
@@ -61,3 +67,25 @@ some-problem = 😱 Упс, Что-то не так
 change-lang = Ты успешно установил русский язык 🇷🇺
 
 unsupported-message = Такой тип сообщений пока не поддерживается.
+
+photo-unavailable = ⚠️ Фото недоступно
+
+change-format-md = Теперь ты будешь получать один Markdown-файл со встроенными картинками 📄
+
+change-format-zip = Теперь ты будешь получать zip-архив с Markdown-файлом и отдельными картинками 🗜
+
+too-busy = ⏳ Слишком много сообщений в обработке. Дождись готовых файлов по уже отправленным сообщениям и попробуй снова.
+
+batch-started = 📚 Режим пакета включен. Перешли до { $max_messages } сообщений и отправь /done, чтобы получить их одним файлом.
+
+batch-full = ⚠️ Пакет заполнен: { $max_messages } сообщений. Отправь /done, чтобы получить файл, следующие сообщения пропускаются.
+
+batch-empty = Пакет пуст, конвертировать нечего.
+
+batch-not-started = Сначала отправь /batch, затем перешли сообщения и отправь /done.
+
+change-images-original = Теперь фото будут добавляться в исходном качестве 🖼
+
+change-images-compact = Теперь фото будут уменьшаться до среднего размера, файлы станут меньше 🗂
+
+change-images-preview = Теперь фото будут уменьшаться до небольших превью, файлы станут намного меньше 🔍
\ No newline at end of file
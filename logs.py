@@ -0,0 +1,166 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List
+
+from cache import LRUCache
+from config import config
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+user_id_var: ContextVar[int | None] = ContextVar("user_id", default=None)
+
+JSON_FORMAT = "json"
+
+# Attributes of every LogRecord, everything else came from extra=
+_RECORD_ATTRS = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__.keys()
+    | {"message", "asctime", "request_id", "user_id", "taskName"}
+)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Adds request_id and user_id of the current update to the record
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+
+class UserRateLimitFilter(logging.Filter):
+    """
+    Samples and rate limits records of the single user, so a burst of messages
+    from one user can't flood the logs. Warnings and errors are always passed.
+    """
+
+    def __init__(self, rate: float, burst: int, sample_rate: float):
+        """
+        :param rate: Records per second of the single user
+        :param burst: Max records of the single user in a row
+        :param sample_rate: Part of the user records to keep, from 0 to 1
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        # user id -> [tokens, updated at]
+        self.buckets: LRUCache[List[float]] = LRUCache(10000, sizeof=lambda value: 1)
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        user_id = getattr(record, "user_id", None)
+        if user_id is None or record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.dropped += 1
+            return False
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = [float(self.burst), now]
+                self.buckets.set(user_id, bucket)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record with the request context and extra= fields
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "location": f"{record.filename}:{record.lineno}",
+        }
+        if getattr(record, "request_id", None) is not None:
+            data["request_id"] = record.request_id
+        if getattr(record, "user_id", None) is not None:
+            data["user_id"] = record.user_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Puts records to the bounded queue without blocking, records are formatted
+    and written by the listener thread. Records are dropped when the queue is full.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only resolve what can change after the call, formatting is left to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging() -> QueueListener:
+    """
+    Configure the root logger: records go through the queue to the stdout writer thread.\r\n
+    LOV_FORMAT=json switches to the JSON records, any other value is a logging format string
+    :return: Started listener, stopped at exit
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if config.LOV_FORMAT == JSON_FORMAT:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(config.LOV_FORMAT))
+
+    queue_handler = BackgroundQueueHandler(queue.Queue(config.LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(
+        UserRateLimitFilter(
+            rate=config.LOG_USER_RATE,
+            burst=config.LOG_USER_BURST,
+            sample_rate=config.LOG_SAMPLE_RATE,
+        )
+    )
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(queue_handler)
+    root.setLevel(config.LOG_LEVEL)
+
+    listener = QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,41 +1,115 @@
+import time
+
+# Taken before the other imports, so they are counted in the startup time
+started_at = time.perf_counter()
+
 import asyncio
-import base64
-import io
+import hashlib
+import json
 import logging
-import sys
+import os
+import signal
+import socket
+from multiprocessing import Queue
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import List, Set
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, BufferedInputFile, BotCommand, FSInputFile
-from aiogram.enums import ContentType
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.types import Message, BotCommand, FSInputFile
+from aiogram.enums import ChatAction, ContentType
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.utils.media_group import MediaGroupBuilder
-from aiogram_i18n.cores import FluentRuntimeCore
 from aiogram_i18n import I18nContext, I18nMiddleware
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.context import FSMContext
 from redis.asyncio import client
 
-from config import config
+from batch import (
+    BatchEntry,
+    BatchState,
+    BatchStore,
+    MemoryBatchBackend,
+    RedisBatchBackend,
+    pack_message,
+    unpack_entities,
+    unpack_photos,
+)
+from cache import ConversionCache, LocaleCache, conversion_key
+from album import AlbumAggregator, MemoryAlbumBackend, RedisAlbumBackend
+from config import config, ConversionMode, RunMode
+from fluent_cache import CachedFluentCompileCore
+from images import ImagePolicy, select_photo
+from document import MESSAGE_SEPARATOR, Document, OutputMode, create_document
+from executor import ConversionExecutor
 from middleware import (
     LongTimeMiddleware,
     MediaGroupMiddleware,
     LocaleManageMiddleware,
     DevModeMiddleware,
     LoggerMiddleware,
+    FairSchedulerMiddleware,
+    MetricsMiddleware,
+    ProfilingMiddleware,
+)
+from jobs import ConversionJob, JobQueue
+from logs import setup_logging
+from media import (
+    create_spill_scope,
+    download_files,
+    image_processor,
+    media_cache,
+    memory_budget,
+)
+from metrics import (
+    ALBUM_SIZE,
+    STAGE_LATENCY,
+    UPLOADED_BYTES,
+    StartupTimer,
+    monitor_loop_lag,
+    registry,
+    start_metrics_server,
 )
-from utils import parse_html_to_md
+from outbound import OutboundScheduler
+from profiling import Profiler
+from progress import ProgressTicker
+from scheduler import FairScheduler
+from webhook import consume_updates, run_webhook_listener, start_workers
 
+startup_timer = StartupTimer(started_at)
+startup_timer.mark("imports")
 
 redis = (
     client.Redis(password=config.REDIS_PASSWORD, host=config.REDIS_HOST)
     if config.APP_MODE == "prod"
     else None
 )
+if redis and config.MEDIA_CACHE_REDIS:
+    media_cache.redis = redis
+
+conversion_cache = ConversionCache(
+    max_items=config.CONVERSION_CACHE_SIZE,
+    ttl=config.CONVERSION_CACHE_TTL,
+    redis=redis if config.CONVERSION_CACHE_REDIS else None,
+)
+
+job_queue = None
+if config.CONVERSION_MODE == ConversionMode.QUEUE:
+    if redis is None:
+        raise RuntimeError("Redis is required in queue conversion mode")
+    job_queue = JobQueue(
+        redis,
+        stream=config.JOB_STREAM,
+        group=config.JOB_GROUP,
+        dead_letter_stream=config.JOB_DEAD_LETTER_STREAM,
+        max_retries=config.JOB_MAX_RETRIES,
+        visibility_timeout=config.JOB_VISIBILITY_TIMEOUT,
+        max_len=config.JOB_DEAD_LETTER_MAX_LEN,
+    )
 
 dp = Dispatcher(
     storage=MemoryStorage() if config.APP_MODE == "dev" else RedisStorage(redis)
@@ -43,6 +117,215 @@ dp = Dispatcher(
 
 logger = logging.getLogger(__name__)
 
+background_tasks: Set[asyncio.Task] = set()
+
+batch_store = BatchStore(
+    backend=(
+        RedisBatchBackend(redis, ttl=config.BATCH_TTL)
+        if redis
+        else MemoryBatchBackend()
+    ),
+    max_messages=config.BATCH_MAX_MESSAGES,
+)
+
+# Parsing of long texts and base64 of large photos, off the event loop
+conversion_executor = ConversionExecutor(
+    mode=config.CONVERSION_EXECUTOR,
+    workers=config.CONVERSION_WORKERS,
+    parse_min_chars=config.PARSE_OFFLOAD_MIN_CHARS,
+    encode_min_bytes=config.ENCODE_OFFLOAD_MIN_BYTES,
+)
+
+profiler = Profiler(
+    directory=config.PROFILE_DIR, frames=config.PROFILE_TRACEMALLOC_FRAMES
+)
+
+api_scheduler = OutboundScheduler(
+    global_rate=config.API_GLOBAL_RATE,
+    global_burst=config.API_GLOBAL_BURST,
+    chat_rate=config.API_CHAT_RATE,
+    chat_burst=config.API_CHAT_BURST,
+    group_rate=config.API_GROUP_RATE,
+    max_retries=config.API_MAX_RETRIES,
+    # The bot limit is shared by the webhook and conversion workers
+    redis=redis,
+)
+
+
+async def get_output_mode(state: FSMContext) -> OutputMode:
+    """
+    Output mode chosen by the user, markdown by default
+    :param state: FSM Context
+    :return: Output mode
+    """
+    output_mode = await state.get_value("output_mode")
+    return OutputMode(output_mode) if output_mode else OutputMode.MARKDOWN
+
+
+async def get_image_policy(state: FSMContext) -> ImagePolicy:
+    """
+    Image policy chosen by the user, original photos by default
+    :param state: FSM Context
+    :return: Image policy
+    """
+    image_policy = await state.get_value("image_policy")
+    return ImagePolicy(image_policy) if image_policy else ImagePolicy.ORIGINAL
+
+
+def add_photos(
+    document: Document,
+    photos: List[bytes | None],
+    i18n: I18nContext,
+    first_index: int = 0,
+) -> bool:
+    """
+    Add downloaded photos to the document in the message order.
+    :param document: Markdown document
+    :param photos: Photos content, None for photos that cannot be downloaded
+    :param i18n: i18n Context
+    :param first_index: Document index of the first photo
+    :return: True if all photos are added, False if some are replaced with placeholder
+    """
+    complete = True
+    for index, photo in enumerate(photos, start=first_index):
+        if photo is None:
+            document.add_text(f"\n\n*{i18n.get('photo-unavailable')}*")
+            complete = False
+            continue
+        document.add_photo(index, photo)
+    return complete
+
+
+async def answer_cached_document(message: Message, cache_key: str) -> bool:
+    """
+    Answer with the already uploaded document of the same conversion, if any.
+    :param message: TG Message
+    :param cache_key: Conversion cache key
+    :return: True if answered from the cache
+    """
+    file_id = await conversion_cache.get(cache_key)
+    if file_id is None:
+        return False
+    try:
+        await message.answer_document(file_id)
+        return True
+    except TelegramBadRequest as ex:
+        logger.warning("Cached document %s cannot be sent: %s", file_id, ex)
+        await conversion_cache.delete(cache_key)
+        return False
+
+
+async def send_document(
+    bot: Bot, chat_id: int, document: Document, cache_key: str | None
+) -> None:
+    """
+    Upload the document and remember its file_id for the same conversions.
+    :param bot: Bot instance
+    :param chat_id: TG Chat id
+    :param document: Markdown document
+    :param cache_key: Conversion cache key, None - do not cache
+    :return:
+    """
+    with STAGE_LATENCY.time(stage="upload"):
+        sent_message = await bot.send_document(chat_id, document)
+    UPLOADED_BYTES.inc(document.size)
+    if cache_key and sent_message.document:
+        await conversion_cache.set(cache_key, sent_message.document.file_id)
+
+
+async def answer_document(
+    message: Message, document: Document, cache_key: str | None
+) -> None:
+    await send_document(message.bot, message.chat.id, document, cache_key)
+
+
+async def convert_entries(
+    bot: Bot,
+    chat_id: int,
+    entries: List[BatchEntry],
+    output_mode: OutputMode,
+    i18n: I18nContext,
+    cache_key: str | None = None,
+    image_policy: ImagePolicy = ImagePolicy.ORIGINAL,
+) -> None:
+    """
+    Transform packed messages into the single document and send it
+    :param bot: Bot instance
+    :param chat_id: TG Chat id
+    :param entries: Packed messages in the message order
+    :param output_mode: User output mode
+    :param i18n: i18n Context
+    :param cache_key: Conversion cache key, None - do not cache
+    :param image_policy: User image policy
+    :return:
+    """
+    cur_date = datetime.now().strftime("%Y%m%d_%H%M%S%f")
+    with create_document(
+        output_mode, cur_date, create_spill_scope(), conversion_executor
+    ) as document:
+        media = [photo for entry in entries for photo in unpack_photos(entry)]
+        # Photos of all messages are fetched at once, under the same concurrency limits
+        with STAGE_LATENCY.time(stage="download"):
+            photos = await download_files(
+                bot,
+                media,
+                on_download=document.store_photo,
+                spill=document.spill,
+                image_policy=image_policy,
+            )
+        with STAGE_LATENCY.time(stage="parse"):
+            texts = await conversion_executor.parse_many(
+                [(entry[1], unpack_entities(entry)) for entry in entries]
+            )
+        first_index = 0
+        for number, (entry, text) in enumerate(zip(entries, texts)):
+            if number:
+                document.add_text(MESSAGE_SEPARATOR)
+            document.add_text(text)
+            photos_count = len(entry[3])
+            if not add_photos(
+                document,
+                photos[first_index : first_index + photos_count],
+                i18n,
+                first_index,
+            ):
+                cache_key = None
+            first_index += photos_count
+        await send_document(bot, chat_id, document, cache_key)
+
+
+async def enqueue_conversion(
+    message: Message,
+    entries: List[BatchEntry],
+    output_mode: OutputMode,
+    i18n: I18nContext,
+    cache_key: str | None = None,
+    image_policy: ImagePolicy = ImagePolicy.ORIGINAL,
+) -> bool:
+    """
+    Pass the conversion to the workers in the queue conversion mode
+    :param message: TG Message
+    :param entries: Packed messages in the message order
+    :param output_mode: User output mode
+    :param i18n: i18n Context
+    :param cache_key: Conversion cache key, None - do not cache
+    :param image_policy: User image policy
+    :return: True if the job is enqueued, False if the conversion runs inline
+    """
+    if job_queue is None:
+        return False
+    await job_queue.enqueue(
+        {
+            "chat_id": message.chat.id,
+            "locale": i18n.locale,
+            "output_mode": output_mode.value,
+            "entries": entries,
+            "cache_key": cache_key,
+            "image_policy": image_policy.value,
+        }
+    )
+    return True
+
 
 @dp.message(CommandStart())
 async def command_start_handler(message: Message, i18n: I18nContext) -> None:
@@ -56,11 +339,14 @@ async def command_start_handler(message: Message, i18n: I18nContext) -> None:
 
 
 @dp.message(Command(commands=["example"]))
-async def command_start_handler(message: Message, i18n: I18nContext) -> None:
+async def command_example_handler(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
     """
     Example command handle. Send example message and after transform to markdown file and send
     :param message: TG Message
     :param i18n: i18n Context
+    :param state: FSM Context
     :return:
     """
     media_group = MediaGroupBuilder(caption=i18n.get("example-message"))
@@ -70,7 +356,9 @@ async def command_start_handler(message: Message, i18n: I18nContext) -> None:
     media_group.add_photo(example_photo_2)
     example_message = await message.answer_media_group(media=media_group.build())
 
-    await parse_message_with_media_group(example_message[0], example_message, i18n)
+    await parse_message_with_media_group(
+        example_message[0], example_message, i18n, state
+    )
 
 
 @dp.message(Command(commands=["help"]), flags={"long_operation": True})
@@ -116,50 +404,353 @@ async def command_set_en_lang(message: Message, i18n: I18nContext) -> None:
         await message.answer(i18n.get("some-problem"))
 
 
+@dp.message(Command(commands=["format_md"]))
+async def command_set_md_format(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Changing output format to markdown command handle. Images are embedded into the markdown file.
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        await state.update_data({"output_mode": OutputMode.MARKDOWN.value})
+        await message.answer(i18n.get("change-format-md"))
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+@dp.message(Command(commands=["format_zip"]))
+async def command_set_zip_format(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Changing output format to zip command handle. Images are sent as separate files next to the markdown file.
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        await state.update_data({"output_mode": OutputMode.ZIP.value})
+        await message.answer(i18n.get("change-format-zip"))
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+@dp.message(Command(commands=["images_original"]))
+async def command_set_original_images(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Changing image policy to original command handle. Photos are added in the original quality.
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        await state.update_data({"image_policy": ImagePolicy.ORIGINAL.value})
+        await message.answer(i18n.get("change-images-original"))
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+@dp.message(Command(commands=["images_compact"]))
+async def command_set_compact_images(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Changing image policy to compact command handle. Photos are reduced to a moderate size.
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        await state.update_data({"image_policy": ImagePolicy.COMPACT.value})
+        await message.answer(i18n.get("change-images-compact"))
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+@dp.message(Command(commands=["images_preview"]))
+async def command_set_preview_images(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Changing image policy to preview command handle. Photos are reduced to small previews.
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        await state.update_data({"image_policy": ImagePolicy.PREVIEW.value})
+        await message.answer(i18n.get("change-images-preview"))
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+@dp.message(Command(commands=["profile"]))
+async def command_profile_handler(
+    message: Message, command: CommandObject, i18n: I18nContext
+) -> None:
+    """
+    Admin profiling command handle. Profile the next requests of the process and send the summary.
+    "/profile 50" profiles 50 requests, "/profile 30s" profiles 30 seconds.
+    :param message: TG Message
+    :param command: Command with arguments
+    :param i18n: i18n Context
+    :return:
+    """
+    if str(message.from_user.id) not in (config.BOT_ADMIN_CHAT_ID or []):
+        await message.answer(i18n.get("unsupported-message"))
+        return
+    requests = config.PROFILE_DEFAULT_REQUESTS
+    seconds = config.PROFILE_MAX_SECONDS
+    argument = (command.args or "").strip().lower()
+    try:
+        if argument.endswith("s"):
+            seconds = min(float(argument[:-1]), config.PROFILE_MAX_SECONDS)
+            requests = None
+        elif argument:
+            requests = int(argument)
+    except ValueError:
+        await message.answer("Usage: /profile [requests | seconds s]")
+        return
+    if not profiler.start(message.bot, message.chat.id, requests, seconds):
+        await message.answer("Profiling is already running")
+        return
+    await message.answer(
+        f"Profiling {requests or 'all'} requests, at most {seconds:g} s"
+    )
+
+
+@dp.message(Command(commands=["batch"]))
+async def command_batch_handler(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Batch mode command handle. Next messages are collected until /done and sent as a single document
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        await batch_store.start(state)
+        await message.answer(
+            i18n.get("batch-started", max_messages=config.BATCH_MAX_MESSAGES)
+        )
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+@dp.message(Command(commands=["done"]), flags={"long_operation": True})
+async def command_done_handler(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Batch finish command handle. Transforming all collected messages into the single document
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        entries = await batch_store.pop(state)
+        if entries is None:
+            await message.answer(i18n.get("batch-not-started"))
+            return
+        if not entries:
+            await message.answer(i18n.get("batch-empty"))
+            return
+        output_mode = await get_output_mode(state)
+        image_policy = await get_image_policy(state)
+        if await enqueue_conversion(
+            message, entries, output_mode, i18n, image_policy=image_policy
+        ):
+            return
+        await convert_entries(
+            message.bot,
+            message.chat.id,
+            entries,
+            output_mode,
+            i18n,
+            image_policy=image_policy,
+        )
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+async def add_to_batch(
+    message: Message, entry: BatchEntry, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Add packed message to the batch, notify the user about each message skipped
+    because the batch is full
+    :param message: TG Message
+    :param entry: Packed message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    if await batch_store.add(state, entry) is None:
+        await message.answer(
+            i18n.get("batch-full", max_messages=config.BATCH_MAX_MESSAGES)
+        )
+
+
+@dp.message(
+    BatchState.collecting,
+    F.photo & F.media_group_id,
+    flags={"get_media_group": True},
+)
+async def collect_media_group(
+    message: Message,
+    album: List[Message] | None,
+    i18n: I18nContext,
+    state: FSMContext,
+) -> None:
+    """
+    Album in the batch mode handle. Album is stored until /done
+    :param message: TG Message
+    :param album: Array of TG Message containing Photo
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        album = sorted(album, key=lambda album_message: album_message.message_id)
+        message = next(
+            (album_message for album_message in album if album_message.caption),
+            album[0],
+        )
+        entry = pack_message(message, album, await get_image_policy(state))
+        await add_to_batch(message, entry, i18n, state)
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
+@dp.message(BatchState.collecting, F.text | F.caption | F.photo)
+async def collect_message(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
+    """
+    Message in the batch mode handle. Message is stored until /done
+    :param message: TG Message
+    :param i18n: i18n Context
+    :param state: FSM Context
+    :return:
+    """
+    try:
+        entry = pack_message(message, image_policy=await get_image_policy(state))
+        await add_to_batch(message, entry, i18n, state)
+    except Exception as ex:
+        logger.error(ex)
+        await message.answer(i18n.get("some-problem"))
+
+
 @dp.message(F.text, flags={"long_operation": True})
-async def parse_message(message: Message, i18n: I18nContext) -> None:
+async def parse_message(message: Message, i18n: I18nContext, state: FSMContext) -> None:
     """
     Clear text handle. Transforming text from telegram markup to markdown markup and sent it's into markdown file.
     :param message: TG Message
     :param i18n: i18n Context
+    :param state: FSM Context
     :return:
     """
     try:
-        parsed_message = parse_html_to_md(message.html_text, message.entities)
-        cur_date = datetime.now().strftime("%Y%m%d_%H%M%S%f")
-        text_file = BufferedInputFile(
-            parsed_message.encode(encoding="utf-8"), filename=f"{cur_date}.md"
+        output_mode = await get_output_mode(state)
+        cache_key = conversion_key(
+            message.text, message.entities, output_mode=output_mode.value
         )
-        await message.answer_document(text_file)
+        if await answer_cached_document(message, cache_key):
+            return
+        if await enqueue_conversion(
+            message, [pack_message(message)], output_mode, i18n, cache_key
+        ):
+            return
+        cur_date = datetime.now().strftime("%Y%m%d_%H%M%S%f")
+        with create_document(
+            output_mode, cur_date, create_spill_scope(), conversion_executor
+        ) as document:
+            with STAGE_LATENCY.time(stage="parse"):
+                document.add_text(
+                    await conversion_executor.parse(message.text, message.entities)
+                )
+            await answer_document(message, document, cache_key)
     except Exception as ex:
         logger.error(ex)
         await message.answer(i18n.get("some-problem"))
 
 
 @dp.message(F.caption & (F.media_group_id == None), flags={"long_operation": True})
-async def parse_message_with_caption(message: Message, i18n: I18nContext) -> None:
+async def parse_message_with_caption(
+    message: Message, i18n: I18nContext, state: FSMContext
+) -> None:
     """
     Text with single media data handle. Transforming text from telegram markup to markdown markup,
     transform image to base64 encoding string-link and sent it's into markdown file.
     :param message: TG Message
     :param i18n: i18n Context
+    :param state: FSM Context
     :return:
     """
     try:
-        parsed_message = parse_html_to_md(message.html_text, message.caption_entities)
-        cur_date = datetime.now().strftime("%Y%m%d_%H%M%S%f")
-        if message.photo:
-            buffer = io.BytesIO()
-            await message.bot.download(message.photo[-1].file_id, destination=buffer)
-            b64_stream_value = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            buffer.close()
-            parsed_message += (
-                f"\n\n![TG_PHOTO](data:image/jpeg;base64,{b64_stream_value})"
-            )
-        text_file = BufferedInputFile(
-            parsed_message.encode(encoding="utf-8"), filename=f"{cur_date}.md"
+        output_mode = await get_output_mode(state)
+        image_policy = await get_image_policy(state)
+        media = [select_photo(message.photo, image_policy)] if message.photo else []
+        cache_key = conversion_key(
+            message.caption,
+            message.caption_entities,
+            [photo.file_unique_id for photo in media],
+            output_mode.value,
+            image_policy.value,
         )
-        await message.answer_document(text_file)
+        if await answer_cached_document(message, cache_key):
+            return
+        if await enqueue_conversion(
+            message,
+            [pack_message(message, image_policy=image_policy)],
+            output_mode,
+            i18n,
+            cache_key,
+            image_policy,
+        ):
+            return
+        cur_date = datetime.now().strftime("%Y%m%d_%H%M%S%f")
+        with create_document(
+            output_mode, cur_date, create_spill_scope(), conversion_executor
+        ) as document:
+            with STAGE_LATENCY.time(stage="parse"):
+                document.add_text(
+                    await conversion_executor.parse(
+                        message.caption, message.caption_entities
+                    )
+                )
+            with STAGE_LATENCY.time(stage="download"):
+                photos = await download_files(
+                    message.bot,
+                    media,
+                    on_download=document.store_photo,
+                    spill=document.spill,
+                    image_policy=image_policy,
+                )
+            if not add_photos(document, photos, i18n):
+                cache_key = None
+            await answer_document(message, document, cache_key)
     except Exception as ex:
         logger.error(ex)
         await message.answer(i18n.get("some-problem"))
@@ -170,7 +761,10 @@ async def parse_message_with_caption(message: Message, i18n: I18nContext) -> Non
     flags={"get_media_group": True, "long_operation": True},
 )
 async def parse_message_with_media_group(
-    message: Message, album: List[Message] | None, i18n: I18nContext
+    message: Message,
+    album: List[Message] | None,
+    i18n: I18nContext,
+    state: FSMContext,
 ) -> None:
     """
     Text with multiple media data handle. Transforming text from telegram markup to markdown markup,
@@ -178,25 +772,61 @@ async def parse_message_with_media_group(
     :param message: TG Message
     :param album: Array of TG Message containing Photo
     :param i18n: i18n Context
+    :param state: FSM Context
     :return:
     """
     try:
-        parsed_message = parse_html_to_md(message.html_text, message.caption_entities)
-        cur_date = datetime.now().strftime("%Y%m%d_%H%M%S%f")
-        for message_photo in album:
-            buffer = io.BytesIO()
-            await message_photo.bot.download(
-                message_photo.photo[-1].file_id, destination=buffer
-            )
-            b64_stream_value = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            buffer.close()
-            parsed_message += (
-                f"\n\n![TG_PHOTO](data:image/jpeg;base64,{b64_stream_value})"
-            )
-        text_file = BufferedInputFile(
-            parsed_message.encode(encoding="utf-8"), filename=f"{cur_date}.md"
+        output_mode = await get_output_mode(state)
+        image_policy = await get_image_policy(state)
+        album = sorted(album, key=lambda album_message: album_message.message_id)
+        ALBUM_SIZE.observe(len(album))
+        media = [
+            select_photo(album_message.photo, image_policy) for album_message in album
+        ]
+        # Caption may be attached to any part, not only to the first received one
+        message = next(
+            (album_message for album_message in album if album_message.caption),
+            album[0],
         )
-        await message.answer_document(text_file)
+        cache_key = conversion_key(
+            message.caption,
+            message.caption_entities,
+            [photo.file_unique_id for photo in media],
+            output_mode.value,
+            image_policy.value,
+        )
+        if await answer_cached_document(message, cache_key):
+            return
+        if await enqueue_conversion(
+            message,
+            [pack_message(message, album, image_policy)],
+            output_mode,
+            i18n,
+            cache_key,
+            image_policy,
+        ):
+            return
+        cur_date = datetime.now().strftime("%Y%m%d_%H%M%S%f")
+        with create_document(
+            output_mode, cur_date, create_spill_scope(), conversion_executor
+        ) as document:
+            with STAGE_LATENCY.time(stage="parse"):
+                document.add_text(
+                    await conversion_executor.parse(
+                        message.caption, message.caption_entities
+                    )
+                )
+            with STAGE_LATENCY.time(stage="download"):
+                photos = await download_files(
+                    message.bot,
+                    media,
+                    on_download=document.store_photo,
+                    spill=document.spill,
+                    image_policy=image_policy,
+                )
+            if not add_photos(document, photos, i18n):
+                cache_key = None
+            await answer_document(message, document, cache_key)
     except Exception as ex:
         logger.error(ex)
         await message.answer(i18n.get("some-problem"))
@@ -213,40 +843,251 @@ async def unknown_handler(message: Message, i18n: I18nContext) -> None:
     await message.answer(i18n.get("unsupported-message"))
 
 
-async def main() -> None:
+def create_bot() -> Bot:
     # Initialize Bot instance with default bot properties which will be passed to all API calls
     bot = Bot(
         token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
+    # All sending requests of the process share the Telegram limits
+    bot.session.middleware(api_scheduler)
+    return bot
+
+
+def setup_dispatcher() -> None:
+    album_aggregator = AlbumAggregator(
+        backend=RedisAlbumBackend(redis) if redis else MemoryAlbumBackend(),
+        debounce=config.ALBUM_DEBOUNCE,
+        max_wait=config.ALBUM_MAX_WAIT,
+    )
+    scheduler = FairScheduler(
+        workers=config.SCHEDULER_WORKERS,
+        max_queue_per_user=config.SCHEDULER_MAX_QUEUE_PER_USER,
+    )
+    registry.add_collector("bot_media_cache", media_cache.stats)
+    registry.add_collector("bot_memory_budget", memory_budget.stats)
+    registry.add_collector("bot_images", image_processor.stats)
+    registry.add_collector("bot_executor", conversion_executor.stats)
+    registry.add_collector("bot_conversion_cache", conversion_cache.stats)
+    registry.add_collector("bot_album", album_aggregator.stats)
+    locale_cache = LocaleCache(
+        max_items=config.LOCALE_CACHE_SIZE,
+        ttl=config.LOCALE_CACHE_TTL,
+        redis=redis,
+    )
+    registry.add_collector("bot_scheduler", scheduler.stats)
+    registry.add_collector("bot_locale_cache", locale_cache.stats)
+    registry.add_collector("bot_api", api_scheduler.stats)
+    if job_queue is not None:
+        registry.add_collector("bot_jobs", job_queue.stats)
+
+    dp.message.middleware(MetricsMiddleware())
+    dp.message.middleware(ProfilingMiddleware(profiler))
     dp.message.middleware(LoggerMiddleware())
     dp.message.middleware(DevModeMiddleware())
-    dp.message.middleware(MediaGroupMiddleware())
-    dp.message.middleware(LongTimeMiddleware())
+    dp.message.middleware(MediaGroupMiddleware(album_aggregator))
+    dp.message.middleware(
+        LongTimeMiddleware(
+            ProgressTicker(
+                mode=config.PROGRESS_MODE,
+                delay=config.PROGRESS_DELAY,
+                interval=config.PROGRESS_INTERVAL,
+                max_calls_per_tick=config.PROGRESS_MAX_CALLS_PER_TICK,
+            )
+        )
+    )
+    dp.message.middleware(FairSchedulerMiddleware(scheduler))
+
+    i18n_middleware = I18nMiddleware(
+        core=CachedFluentCompileCore(
+            path="locales/{locale}/LC_MESSAGES",
+            cache_dir=Path(config.STARTUP_CACHE_DIR, "locales"),
+        ),
+        default_locale="en",
+        manager=LocaleManageMiddleware(locale_cache),
+    )
+    i18n_middleware.setup(dispatcher=dp)
+
 
+async def prepare_dispatcher() -> None:
+    """
+    Set up the dispatcher and load the locales before the updates are handled
+    :return:
+    """
+    setup_dispatcher()
+    startup_timer.mark("dispatcher")
+    # Startup of the core is idempotent, the dispatcher startup doesn't reload them
+    await dp["i18n_middleware"].core.startup()
+    startup_timer.mark("locales")
+
+
+async def set_commands(bot: Bot) -> None:
     commands = [
         BotCommand(command="/start", description="🏁 Start"),
         BotCommand(command="/help", description="❓ Help"),
         BotCommand(command="/example", description="📲 Example"),
         BotCommand(command="/language_ru", description="🇷🇺 RU Language"),
         BotCommand(command="/language_en", description="🇬🇧 EN Language"),
+        BotCommand(command="/format_md", description="📄 Markdown file"),
+        BotCommand(command="/format_zip", description="🗜 Zip with images"),
+        BotCommand(command="/images_original", description="🖼 Original photos"),
+        BotCommand(command="/images_compact", description="🗂 Compact photos"),
+        BotCommand(command="/images_preview", description="🔍 Photo previews"),
+        BotCommand(command="/batch", description="📚 Collect messages"),
+        BotCommand(command="/done", description="✅ Finish collecting"),
     ]
+    # Commands are pushed only when changed, so restarts make no API calls
+    digest = hashlib.sha256(
+        json.dumps(
+            [bot.id] + [command.model_dump() for command in commands],
+            ensure_ascii=False,
+        ).encode("utf-8")
+    ).hexdigest()
+    digest_path = Path(config.STARTUP_CACHE_DIR, "commands.sha256")
+    try:
+        pushed = digest_path.read_text() == digest
+        checked_at = digest_path.stat().st_mtime
+    except OSError:
+        pushed, checked_at = False, 0.0
+    if pushed and time.time() - checked_at < config.COMMANDS_CHECK_INTERVAL:
+        return
+    if pushed:
+        # Commands may be changed outside the bot, e.g. in BotFather
+        try:
+            current = await bot.get_my_commands()
+        except Exception as ex:
+            logger.warning("Cannot get bot commands: %s", ex)
+            current = []
+        if [(command.command, command.description) for command in current] == [
+            (command.command.lstrip("/"), command.description) for command in commands
+        ]:
+            digest_path.touch()
+            return
     await bot.set_my_commands(commands)
+    try:
+        digest_path.parent.mkdir(parents=True, exist_ok=True)
+        digest_path.write_text(digest)
+    except OSError as ex:
+        logger.warning("Cannot save commands digest: %s", ex)
 
-    i18n_middleware = I18nMiddleware(
-        core=FluentRuntimeCore(
-            path="locales/{locale}/LC_MESSAGES",
-        ),
-        default_locale="en",
-        manager=LocaleManageMiddleware(),
+
+async def start_metrics(port: int) -> None:
+    """
+    Start metrics endpoint and event loop lag monitor of the process
+    :param port: Metrics port of the process
+    :return:
+    """
+    if not config.METRICS_ENABLED:
+        return
+    await start_metrics_server(config.METRICS_HOST, port)
+    task = asyncio.create_task(
+        monitor_loop_lag(config.LOOP_LAG_INTERVAL, config.LOOP_STALL_THRESHOLD)
     )
-    i18n_middleware.setup(dispatcher=dp)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
 
+async def run_webhook_worker(updates: Queue, index: int) -> None:
+    """
+    Webhook worker process: handle updates routed to this worker by the listener
+    :param updates: Updates queue of the worker
+    :param index: Worker index
+    :return:
+    """
+    bot = create_bot()
+    await prepare_dispatcher()
+    await start_metrics(config.METRICS_PORT + 1 + index)
+    startup_timer.mark("metrics")
+    startup_timer.report()
+    await consume_updates(dp, bot, updates)
+
+
+def start_webhook_worker(updates: Queue, index: int) -> None:
+    setup_logging()
+    asyncio.run(run_webhook_worker(updates, index))
+
+
+async def run_conversion_job(bot: Bot, job: ConversionJob) -> None:
+    """
+    Convert the job enqueued by the bot, exceptions are retried by the queue
+    :param bot: Bot instance
+    :param job: Conversion job
+    :return:
+    """
+    i18n_middleware = dp["i18n_middleware"]
+    i18n = I18nContext(
+        locale=job["locale"],
+        core=i18n_middleware.core,
+        manager=i18n_middleware.manager,
+        data={},
+    )
+    await bot.send_chat_action(job["chat_id"], ChatAction.UPLOAD_DOCUMENT)
+    await convert_entries(
+        bot,
+        job["chat_id"],
+        job["entries"],
+        OutputMode(job["output_mode"]),
+        i18n,
+        job["cache_key"],
+        # Jobs enqueued before the image policies were added have none
+        ImagePolicy(job.get("image_policy", ImagePolicy.ORIGINAL)),
+    )
+
+
+async def run_conversion_worker() -> None:
+    """
+    Conversion worker process: handle the jobs enqueued by the bot in the queue conversion mode
+    :return:
+    """
+    if job_queue is None:
+        raise RuntimeError("Conversion worker requires queue conversion mode")
+    bot = create_bot()
+    await prepare_dispatcher()
+    await start_metrics(config.METRICS_PORT)
+    startup_timer.mark("metrics")
+    startup_timer.report()
+
+    async def notify_failed(job: ConversionJob, error: str) -> None:
+        core = dp["i18n_middleware"].core
+        await bot.send_message(job["chat_id"], core.get("some-problem", job["locale"]))
+
+    loop = asyncio.get_running_loop()
+    # Jobs in progress are finished, the new ones are left to the other workers
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, job_queue.stop)
+    try:
+        await job_queue.consume(
+            consumer=f"{socket.gethostname()}-{os.getpid()}",
+            handler=lambda job: run_conversion_job(bot, job),
+            on_dead_letter=notify_failed,
+            concurrency=config.JOB_WORKER_CONCURRENCY,
+        )
+    finally:
+        await bot.session.close()
+
+
+async def main(webhook_queues: List[Queue] | None = None) -> None:
+    bot = create_bot()
+    await set_commands(bot)
+    startup_timer.mark("commands")
+    await start_metrics(config.METRICS_PORT)
+    startup_timer.mark("metrics")
+
+    if config.RUN_MODE == RunMode.WEBHOOK:
+        startup_timer.report()
+        # Updates are handled by the worker processes
+        await run_webhook_listener(bot, dp.resolve_used_update_types(), webhook_queues)
+        return
+
+    await prepare_dispatcher()
+    startup_timer.report()
     # And the run events dispatching
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=config.LOG_LEVEL, format=config.LOV_FORMAT, stream=sys.stdout
-    )
-    asyncio.run(main())
+    setup_logging()
+    queues = None
+    if config.RUN_MODE == RunMode.WEBHOOK:
+        # Workers are started before the event loop of the listener
+        queues = start_workers(config.WEBHOOK_WORKERS, start_webhook_worker)
+    asyncio.run(main(queues))
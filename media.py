@@ -0,0 +1,142 @@
+import asyncio
+import io
+import logging
+from pathlib import Path
+from typing import Callable, List, Sequence
+
+from aiogram import Bot
+from aiogram.types import PhotoSize
+
+from cache import MediaCache
+from config import config
+from document import Photo
+from images import ImagePolicy, ImageProcessor
+from metrics import DOWNLOADED_BYTES
+from spill import MemoryBudget, SpillScope
+
+logger = logging.getLogger(__name__)
+
+# Shared by all requests of the process, limits the load on the Bot API file server
+global_download_semaphore = asyncio.Semaphore(config.MEDIA_DOWNLOAD_GLOBAL_CONCURRENCY)
+
+# Media and documents of all requests kept in memory, the rest is spilled to disk
+memory_budget = MemoryBudget(config.MEMORY_BUDGET_BYTES)
+
+# Shared Redis tier is attached in main.py when the bot runs with Redis
+media_cache = MediaCache(
+    max_bytes=config.MEDIA_CACHE_MAX_BYTES,
+    ttl=config.MEDIA_CACHE_TTL,
+    redis_max_item_bytes=config.MEDIA_CACHE_REDIS_MAX_ITEM_BYTES,
+    redis_max_bytes=config.MEDIA_CACHE_REDIS_MAX_BYTES,
+)
+
+
+# Recompression of the photos for the compact and preview image policies
+image_processor = ImageProcessor(
+    workers=config.IMAGE_WORKERS,
+    quality=config.IMAGE_QUALITY,
+    image_format=config.IMAGE_FORMAT,
+)
+
+
+def create_spill_scope() -> SpillScope:
+    """
+    Memory budget and temp files scope of the single conversion
+    """
+    return SpillScope(memory_budget, config.MEDIA_SPILL_THRESHOLD, config.SPILL_DIR)
+
+
+async def download_file(
+    bot: Bot,
+    file: PhotoSize,
+    request_semaphore: asyncio.Semaphore,
+    spill: SpillScope | None = None,
+) -> Photo | None:
+    """
+    Get file from the media cache or download it under the request and global
+    concurrency limits
+    :param bot: Bot instance
+    :param file: TG file
+    :param request_semaphore: Per-request concurrency limit
+    :param spill: Memory budget of the request, files which don't fit go to temp files
+    :return: File content, temp file path if spilled, or None if download failed
+    """
+    cached = await media_cache.get(file.file_unique_id)
+    if cached is not None:
+        return cached
+    # Files without known size are expected to be as large as the threshold
+    size = file.file_size or config.MEDIA_SPILL_THRESHOLD
+    if spill is not None and not spill.reserve(size):
+        return await download_to_disk(bot, file, request_semaphore, spill)
+    async with request_semaphore, global_download_semaphore:
+        buffer = io.BytesIO()
+        try:
+            await bot.download(file.file_id, destination=buffer)
+            content = buffer.getvalue()
+        except Exception as ex:
+            logger.error("Cannot download file %s: %s", file.file_id, ex)
+            return None
+        finally:
+            buffer.close()
+    DOWNLOADED_BYTES.inc(len(content))
+    await media_cache.set(file.file_unique_id, content)
+    return content
+
+
+async def download_to_disk(
+    bot: Bot,
+    file: PhotoSize,
+    request_semaphore: asyncio.Semaphore,
+    spill: SpillScope,
+) -> Path | None:
+    """
+    Stream file into the temp file of the request, large files are not cached
+    :param bot: Bot instance
+    :param file: TG file
+    :param request_semaphore: Per-request concurrency limit
+    :param spill: Temp files of the request, the file is removed with them
+    :return: Temp file path or None if download failed
+    """
+    path = spill.temp_path(suffix=".jpg")
+    async with request_semaphore, global_download_semaphore:
+        try:
+            await bot.download(file.file_id, destination=path)
+        except Exception as ex:
+            logger.error("Cannot download file %s: %s", file.file_id, ex)
+            return None
+    DOWNLOADED_BYTES.inc(path.stat().st_size)
+    return path
+
+
+async def download_files(
+    bot: Bot,
+    files: Sequence[PhotoSize],
+    concurrency: int = config.MEDIA_DOWNLOAD_CONCURRENCY,
+    on_download: Callable[[int, Photo], None] | None = None,
+    spill: SpillScope | None = None,
+    image_policy: ImagePolicy | str = ImagePolicy.ORIGINAL,
+) -> List[Photo | None]:
+    """
+    Download files concurrently, result keeps the order of files.
+    Failed downloads are returned as None, so the caller can insert a placeholder.
+    :param bot: Bot instance
+    :param files: TG files
+    :param concurrency: Max parallel downloads for this request
+    :param on_download: Called with file index and content as soon as each file is ready
+    :param spill: Memory budget and temp files of the request, None - download all in memory
+    :param image_policy: User image policy, photos above its limits are recompressed
+    :return: Files content or temp file paths in the order of files
+    """
+    request_semaphore = asyncio.Semaphore(concurrency)
+
+    async def download(index: int, file: PhotoSize) -> Photo | None:
+        content = await download_file(bot, file, request_semaphore, spill)
+        if content is not None:
+            content = await image_processor.process(content, file, image_policy)
+        if content is not None and on_download is not None:
+            on_download(index, content)
+        return content
+
+    return await asyncio.gather(
+        *(download(index, file) for index, file in enumerate(files))
+    )
@@ -0,0 +1,289 @@
+import asyncio
+import bisect
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value)}"'.replace("\n", " ")
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    @abstractmethod
+    def samples(self) -> Iterator[Tuple[str, LabelValues, Sequence[str], float]]:
+        """
+        (name suffix, label values, label names, value) of each sample
+        """
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, values, names, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield "", key, self.label_names, value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        self.values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (bucket counts, sum, count)
+        self.values: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        item = self.values.get(key)
+        if item is None:
+            item = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            item[0][index] += 1
+        item[1] += value
+        item[2] += 1
+
+    def totals(self) -> Dict[LabelValues, Tuple[float, int]]:
+        """
+        Sum and count of the observed values by label values
+        """
+        return {key: (total, count) for key, (_, total, count) in self.values.items()}
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self):
+        names = self.label_names + ("le",)
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", key + (repr(float(bucket)),), names, cumulative
+            yield "_bucket", key + ("+Inf",), names, count
+            yield "_sum", key, self.label_names, total
+            yield "_count", key, self.label_names, count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(
+        self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, prefix: str, stats: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Expose stats() dict of a component as gauges, nested keys are joined with _
+        :param prefix: Metrics name prefix
+        :param stats: Function returning the component stats
+        """
+        self.collectors.append((prefix, stats))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for prefix, stats in self.collectors:
+            try:
+                flat = self._flatten(prefix, stats())
+            except Exception as ex:
+                logger.error("Cannot collect %s stats: %s", prefix, ex)
+                continue
+            for name, value in flat:
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def _flatten(self, prefix: str, stats: Dict[str, Any]) -> List[Tuple[str, float]]:
+        result = []
+        for key, value in stats.items():
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                result.extend(self._flatten(name, value))
+            elif isinstance(value, (int, float)):
+                result.append((name, value))
+        return result
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.histogram(
+    "bot_handler_duration_seconds", "Handler processing time", ["handler"]
+)
+HANDLER_ERRORS = registry.counter(
+    "bot_handler_errors_total", "Handler unhandled exceptions", ["handler"]
+)
+STAGE_LATENCY = registry.histogram(
+    "bot_stage_duration_seconds",
+    "Conversion stage time: parse, download, upload",
+    ["stage"],
+)
+DOWNLOADED_BYTES = registry.counter(
+    "bot_downloaded_bytes_total", "Bytes downloaded from Telegram"
+)
+UPLOADED_BYTES = registry.counter("bot_uploaded_bytes_total", "Bytes of sent documents")
+ALBUM_SIZE = registry.histogram(
+    "bot_album_size", "Photos in the album", buckets=(1, 2, 3, 4, 5, 6, 7, 8, 9, 10)
+)
+IN_FLIGHT = registry.gauge("bot_in_flight_requests", "Handlers running right now")
+LOOP_LAG = registry.histogram(
+    "bot_event_loop_lag_seconds",
+    "Event loop scheduling delay",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+LOOP_STALLS = registry.counter(
+    "bot_event_loop_stalls_total", "Event loop delays above the stall threshold"
+)
+STARTUP_TIME = registry.gauge(
+    "bot_startup_seconds", "Process startup time by stage", ["stage"]
+)
+
+
+class StartupTimer:
+    """
+    Startup time breakdown: each mark closes the stage started by the previous one
+    """
+
+    def __init__(self, started_at: float):
+        """
+        :param started_at: time.perf_counter() of the process start
+        """
+        self.started_at = started_at
+        self.last_mark_at = started_at
+        self.stages: Dict[str, float] = {}
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stages[stage] = now - self.last_mark_at
+        self.last_mark_at = now
+        STARTUP_TIME.set(self.stages[stage], stage=stage)
+
+    def report(self) -> None:
+        total = self.last_mark_at - self.started_at
+        STARTUP_TIME.set(total, stage="total")
+        logger.info(
+            "Started in %.3f s: %s",
+            total,
+            ", ".join(f"{stage} {spent:.3f} s" for stage, spent in self.stages.items()),
+        )
+
+
+async def monitor_loop_lag(interval: float, stall_threshold: float) -> None:
+    """
+    Measure how late the event loop wakes up a sleeping task
+    :param interval: Seconds between measurements
+    :param stall_threshold: Lag in seconds logged and counted as a stall
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - started_at - interval, 0)
+        LOOP_LAG.observe(lag)
+        if lag >= stall_threshold:
+            LOOP_STALLS.inc()
+            logger.warning("Event loop stalled for %.3f s", lag)
+
+
+async def start_metrics_server(host: str, port: int) -> "web.AppRunner":
+    """
+    Serve metrics in Prometheus text format on /metrics
+    :param host: Listen host, keep it local
+    :param port: Listen port
+    :return: Runner to clean up on shutdown
+    """
+    # aiohttp.web is not needed by the bot itself, import it only when serving
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(
+            text=registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics on http://%s:%s/metrics", host, port)
+    return runner
@@ -1,6 +1,6 @@
-import asyncio
 import logging
-from typing import List, Union, Callable, Dict, Any, Awaitable
+import time
+from typing import Callable, Dict, Any, Awaitable
 
 from aiogram import BaseMiddleware
 from aiogram.dispatcher.flags import get_flag
@@ -9,11 +9,62 @@ from aiogram.types import Message, TelegramObject
 from aiogram_i18n.managers import BaseManager
 from aiogram.types.user import User
 
+from album import AlbumAggregator
+from cache import LocaleCache
 from config import config, AppMode
+from logs import request_id_var, user_id_var
+from metrics import HANDLER_ERRORS, HANDLER_LATENCY, IN_FLIGHT
+from profiling import Profiler
+from progress import ProgressTicker
+from scheduler import FairScheduler, SchedulerBusy
 
 logger = logging.getLogger(__name__)
 
 
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_name = data["handler"].callback.__name__
+        IN_FLIGHT.inc()
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=handler_name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(
+                time.perf_counter() - started_at, handler=handler_name
+            )
+            IN_FLIGHT.dec()
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    def __init__(self, profiler: Profiler):
+        """
+        Count the requests handled while the profiling session runs
+        """
+        self.profiler = profiler
+        super().__init__()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not self.profiler.active:
+            return await handler(event, data)
+        try:
+            return await handler(event, data)
+        finally:
+            self.profiler.request_done(event.bot)
+
+
 class LoggerMiddleware(BaseMiddleware):
     async def __call__(
         self,
@@ -21,14 +72,29 @@ class LoggerMiddleware(BaseMiddleware):
         event: Message,
         data: Dict[str, Any],
     ) -> Any:
-        logger.info(
-            f"Handle event from user: "
-            f"{event.from_user.id=} "
-            f"{event.from_user.username=} "
-            f"{event.from_user.full_name=} "
-            f"{event.from_user.language_code=}"
-        )
-        return await handler(event, data)
+        user = event.from_user
+        request_id_token = request_id_var.set(str(data["event_update"].update_id))
+        user_id_token = user_id_var.set(user.id)
+        started_at = time.perf_counter()
+        try:
+            logger.info(
+                "Handle event from user: id=%s username=%s full_name=%s language_code=%s",
+                user.id,
+                user.username,
+                user.full_name,
+                user.language_code,
+            )
+            return await handler(event, data)
+        finally:
+            # Handler latency is in the metrics, the record is for debugging only
+            logger.debug(
+                "Event handled",
+                extra={
+                    "duration_ms": round((time.perf_counter() - started_at) * 1000, 1)
+                },
+            )
+            request_id_var.reset(request_id_token)
+            user_id_var.reset(user_id_token)
 
 
 class DevModeMiddleware(BaseMiddleware):
@@ -49,21 +115,13 @@ class DevModeMiddleware(BaseMiddleware):
 
 
 class LongTimeMiddleware(BaseMiddleware):
-    clock_icons: List[str] = [
-        "🕐",
-        "🕑",
-        "🕒",
-        "🕓",
-        "🕔",
-        "🕕",
-        "🕖",
-        "🕗",
-        "🕘",
-        "🕙",
-        "🕚",
-        "🕛",
-    ]
-    msg = None
+    def __init__(self, ticker: ProgressTicker):
+        """
+        Show progress of the handlers flagged with long_operation.
+        All spinners are updated by the single shared ticker.
+        """
+        self.ticker = ticker
+        super().__init__()
 
     async def __call__(
         self,
@@ -75,40 +133,48 @@ class LongTimeMiddleware(BaseMiddleware):
         if not flag:
             return await handler(event, data)
 
-        updated_task = asyncio.create_task(self.show_icon(event))
+        spinner = self.ticker.add(event.bot, event.chat.id)
         try:
-            await handler(event, data)
+            return await handler(event, data)
         finally:
-            await self.hide_icon()
-            updated_task.cancel()
-
-    async def show_icon(self, event: Message):
-        index = 0
-        self.msg = await event.bot.send_message(event.chat.id, self.clock_icons[index])
-        while True:
-            await asyncio.sleep(0.5)
-            index = index + 1 if index < len(self.clock_icons) - 1 else 0
-            icon = self.clock_icons[index]
-            await event.bot.edit_message_text(
-                icon, str(self.msg.chat.id), self.msg.message_id
-            )
+            await self.ticker.remove(spinner)
+
+
+class FairSchedulerMiddleware(BaseMiddleware):
+    def __init__(self, scheduler: FairScheduler):
+        """
+        Run the handlers flagged with long_operation in the shared fair scheduler.
+        Users with a full queue get "too busy" answer.
+        """
+        self.scheduler = scheduler
+        super().__init__()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        flag = get_flag(data, "long_operation")
+        if not flag:
+            return await handler(event, data)
 
-    async def hide_icon(self):
         try:
-            await self.msg.bot.delete_message(self.msg.chat.id, self.msg.message_id)
-        except Exception as ex:
-            logger.error("Cannot delete timer message!", self.msg.chat.id, ex)
+            return await self.scheduler.run(
+                event.from_user.id, lambda: handler(event, data)
+            )
+        except SchedulerBusy:
+            logger.warning("Too many operations of user %s", event.from_user.id)
+            return await event.answer(data["i18n"].get("too-busy"))
 
 
 class MediaGroupMiddleware(BaseMiddleware):
-    album_data: dict[str, List[Message]] = {}
-
-    def __init__(self, latency: Union[int, float] = 0.01):
+    def __init__(self, aggregator: AlbumAggregator):
         """
-        You can provide custom latency to make sure
-        albums are handled properly in highload.
+        Collect album parts and pass them to the handler of the first part as album.
+        Handlers of the other parts are skipped.
         """
-        self.latency = latency
+        self.aggregator = aggregator
         super().__init__()
 
     async def __call__(
@@ -123,26 +189,28 @@ class MediaGroupMiddleware(BaseMiddleware):
         if not flag:
             return await handler(event, data)
 
-        if self.album_data.get(event.media_group_id):
-            self.album_data[event.media_group_id].append(event)
+        album = await self.aggregator.collect(event)
+        if album is None:
             return
-        else:
-            self.album_data[event.media_group_id] = [event]
-            await asyncio.sleep(self.latency)
-            data["is_last"] = True
-            data["album"] = self.album_data[event.media_group_id]
-
-        try:
-            await handler(event, data)
-        finally:
-            if event.media_group_id and data.get("is_last"):
-                del self.album_data[event.media_group_id]
+        data["album"] = album
+        return await handler(event, data)
 
 
 class LocaleManageMiddleware(BaseManager):
+    def __init__(self, cache: LocaleCache, default_locale: str | None = None):
+        """
+        :param cache: User locales cache, storage is read only on cache miss
+        :param default_locale: Locale of the users without language code
+        """
+        super().__init__(default_locale=default_locale)
+        self.cache = cache
+
     async def get_locale(self, event_from_user: User, state: FSMContext) -> str:
         default = event_from_user.language_code or self.default_locale
-        locale = await state.get_value("locale")
+        locale = self.cache.get(state.key)
+        if locale is None:
+            locale = await state.get_value("locale") or ""
+            self.cache.put(state.key, locale)
         if locale:
             return locale
         return default
@@ -151,3 +219,10 @@ class LocaleManageMiddleware(BaseManager):
         self, locale: str, event_from_user: User, state: FSMContext
     ) -> None:
         await state.update_data({"locale": locale})
+        await self.cache.set(state.key, locale)
+
+    async def startup(self, *args: Any, **kwargs: Any) -> None:
+        self.cache.start()
+
+    async def shutdown(self, *args: Any, **kwargs: Any) -> None:
+        await self.cache.stop()
@@ -0,0 +1,315 @@
+import asyncio
+import itertools
+import logging
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import TYPE_CHECKING, Any, Dict, Hashable, List
+
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from redis.asyncio import Redis
+
+from cache import LRUCache
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+# Methods limited by the Telegram send limits, others are passed as is
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward", "delete")
+
+# Token bucket shared by all processes of the bot, Redis time is the common clock.
+# Takes a token if there is one, returns seconds until the next token otherwise.
+GLOBAL_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local delay = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    delay = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(delay)
+"""
+
+
+class Priority(IntEnum):
+    DOCUMENT = 0
+    MESSAGE = 1
+    PROGRESS = 2
+
+
+# Priority of the requests made in the current context, set by the progress ticker
+request_priority: ContextVar[Priority] = ContextVar(
+    "request_priority", default=Priority.MESSAGE
+)
+
+
+class StaleRequestError(Exception):
+    """
+    Progress request was dropped, a newer one for the same message replaced it
+    """
+
+
+class OutboundRequest:
+    def __init__(
+        self, priority: Priority, seq: int, chat_id: int | str, key: Hashable | None
+    ):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        # Progress requests with the same key replace each other
+        self.key = key
+        self.queued_at = time.monotonic()
+        self.throttled = False
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "OutboundRequest") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Bot session middleware scheduling all sending requests of the process.\r\n
+    Requests wait for the global and per-chat token buckets, documents go first and
+    progress updates go last. Queued progress edit of the message is dropped when a newer
+    edit or delete of the same message arrives. retry_after of any request pauses
+    all requests of the process, then the request is retried.
+    With Redis the global bucket is shared by all processes of the bot (webhook and
+    conversion workers), Telegram limits the bot, not the process. Chat buckets stay
+    in the process: updates of the chat are handled by the single process.
+    """
+
+    def __init__(
+        self,
+        global_rate: float,
+        global_burst: int,
+        chat_rate: float,
+        chat_burst: int,
+        group_rate: float,
+        max_retries: int = 2,
+        max_chats: int = 10000,
+        redis: Redis | None = None,
+        global_key: str = "outbound:global",
+    ):
+        """
+        :param global_rate: Requests per second of the bot
+        :param global_burst: Max requests of the bot in a row
+        :param chat_rate: Requests per second to the single private chat
+        :param chat_burst: Max requests to the single chat in a row
+        :param group_rate: Requests per second to the single group chat
+        :param max_retries: Retries of the request after retry_after
+        :param max_chats: Max chats with the tracked limits
+        :param redis: Redis client for the global bucket shared by the processes, None - the bucket of the process
+        :param global_key: Redis key of the shared global bucket
+        """
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.redis = redis
+        self.global_key = global_key
+        self.global_script = (
+            redis.register_script(GLOBAL_BUCKET_SCRIPT) if redis else None
+        )
+        # [tokens, updated at], fallback when the shared bucket is not available
+        self.global_bucket = [float(global_burst), time.monotonic()]
+        # chat id -> [tokens, updated at]
+        self.chat_buckets: LRUCache[List[float]] = LRUCache(
+            max_chats, sizeof=lambda value: 1
+        )
+        self.queue: List[OutboundRequest] = []
+        self.progress: Dict[Hashable, OutboundRequest] = {}
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.blocked_until = 0.0
+        self.sent = 0
+        self.throttled = 0
+        self.dropped = 0
+        self.retry_after = 0
+        self.wait_seconds = 0.0
+        self.shared_errors = 0
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: "Bot",
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not method.__api_method__.startswith(LIMITED_PREFIXES):
+            return await make_request(bot, method)
+        for attempt in itertools.count():
+            await self._acquire(self._request(method, chat_id))
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as ex:
+                self.retry_after += 1
+                self.blocked_until = max(
+                    self.blocked_until, time.monotonic() + ex.retry_after
+                )
+                logger.warning(
+                    "Flood control on %s, all requests paused for %s s",
+                    method.__api_method__,
+                    ex.retry_after,
+                )
+                if attempt >= self.max_retries:
+                    raise
+
+    def _request(
+        self, method: TelegramMethod[Any], chat_id: int | str
+    ) -> OutboundRequest:
+        priority = request_priority.get()
+        if method.__api_method__ in ("sendDocument", "sendMediaGroup"):
+            priority = Priority.DOCUMENT
+        key = None
+        message_id = getattr(method, "message_id", None)
+        if method.__api_method__ == "sendChatAction" or message_id is not None:
+            key = (chat_id, message_id)
+        request = OutboundRequest(priority, next(self.seq), chat_id, key)
+        if key is not None:
+            # Any newer request for the message makes its queued progress edit useless
+            stale = self.progress.pop(key, None)
+            if stale is not None and not stale.future.done():
+                stale.future.set_exception(StaleRequestError())
+                self.dropped += 1
+            if priority == Priority.PROGRESS:
+                self.progress[key] = request
+        return request
+
+    async def _acquire(self, request: OutboundRequest) -> None:
+        self.queue.append(request)
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        try:
+            await request.future
+        finally:
+            if self.progress.get(request.key) is request:
+                del self.progress[request.key]
+        self.wait_seconds += time.monotonic() - request.queued_at
+        self.sent += 1
+
+    async def _run(self) -> None:
+        while self.queue:
+            self.wakeup.clear()
+            now = time.monotonic()
+            if now < self.blocked_until:
+                delay = self.blocked_until - now
+            else:
+                delay = await self._grant(now)
+            if delay:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _grant(self, now: float) -> float:
+        """
+        Let the first request that fits the limits go
+        :param now: Monotonic time
+        :return: Seconds to wait for the next token, 0 if a request was granted
+        """
+        # Cancelled or dropped requests
+        self.queue = [request for request in self.queue if not request.future.done()]
+        chat_delay = 0.0
+        for request in sorted(self.queue):
+            bucket = self._chat_bucket(request.chat_id, now)
+            delay = self._delay(
+                bucket, self._chat_rate(request.chat_id), self.chat_burst, now
+            )
+            if delay:
+                request.throttled = True
+                chat_delay = min(chat_delay, delay) if chat_delay else delay
+                continue
+            global_delay = await self._take_global(now)
+            if global_delay:
+                for queued in self.queue:
+                    queued.throttled = True
+                return global_delay
+            bucket[0] -= 1
+            self.queue.remove(request)
+            self.throttled += request.throttled
+            request.future.set_result(None)
+            return 0
+        return chat_delay
+
+    async def _take_global(self, now: float) -> float:
+        """
+        Take a token of the bot
+        :param now: Monotonic time
+        :return: Seconds until the next token, 0 if the token is taken
+        """
+        if self.global_script is not None:
+            try:
+                delay = await self.global_script(
+                    keys=[self.global_key], args=[self.global_rate, self.global_burst]
+                )
+                return float(delay)
+            except Exception as ex:
+                # Sending is not stopped by Redis, the process limits itself meanwhile
+                self.shared_errors += 1
+                logger.error("Cannot take the shared bot token: %s", ex)
+        delay = self._delay(
+            self.global_bucket, self.global_rate, self.global_burst, now
+        )
+        if not delay:
+            self.global_bucket[0] -= 1
+        return delay
+
+    def _chat_rate(self, chat_id: int | str) -> float:
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.chat_rate
+        return self.group_rate
+
+    def _chat_bucket(self, chat_id: int | str, now: float) -> List[float]:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = [float(self.chat_burst), now]
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    @staticmethod
+    def _delay(bucket: List[float], rate: float, burst: int, now: float) -> float:
+        """
+        Refill the bucket
+        :return: Seconds until the bucket has a token, 0 if it has one now
+        """
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            return 0
+        return (1 - bucket[0]) / rate
+
+    def stats(self) -> Dict[str, Any]:
+        queued = {priority.name.lower(): 0 for priority in Priority}
+        for request in self.queue:
+            queued[request.priority.name.lower()] += 1
+        return {
+            "queued": queued,
+            "sent": self.sent,
+            "throttled": self.throttled,
+            "dropped": self.dropped,
+            "retry_after": self.retry_after,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "blocked": int(time.monotonic() < self.blocked_until),
+            "shared_errors": self.shared_errors,
+        }
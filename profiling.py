@@ -0,0 +1,195 @@
+import asyncio
+import cProfile
+import html
+import logging
+import pstats
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from aiogram import Bot
+
+from metrics import HANDLER_LATENCY, STAGE_LATENCY, LabelValues
+
+logger = logging.getLogger(__name__)
+
+# Telegram message length limit
+MAX_SUMMARY_LENGTH = 4096
+
+
+class ProfilingSession:
+    """
+    CPU profile, memory allocations and stage timings of the single profiling run
+    """
+
+    def __init__(self, chat_id: int, requests: int | None, seconds: float, frames: int):
+        self.chat_id = chat_id
+        self.requests_left = requests
+        self.seconds = seconds
+        self.started_at = time.perf_counter()
+        self.name = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.handled = 0
+        self.stages = STAGE_LATENCY.totals()
+        self.handlers = HANDLER_LATENCY.totals()
+        self.profile = cProfile.Profile()
+        # Allocations are traced only if nothing else traces them already
+        self.trace_memory = not tracemalloc.is_tracing()
+        if self.trace_memory:
+            tracemalloc.start(frames)
+        self.profile.enable()
+
+    def stop(self) -> None:
+        self.profile.disable()
+
+
+class Profiler:
+    """
+    On-demand profiling of the process, started by the admin command.\r\n
+    While no session runs the middleware only checks a single attribute, so there is
+    no overhead. A session profiles everything the event loop runs until the given
+    count of requests is handled or the time is over, then the CPU profile, the
+    tracemalloc snapshot and the summary are written to the directory and the summary
+    is sent to the admin chat.
+    """
+
+    def __init__(self, directory: str, frames: int = 10, top: int = 10):
+        """
+        :param directory: Directory of the profiles
+        :param frames: Stack frames stored by tracemalloc
+        :param top: Hotspots count in the summary
+        """
+        self.directory = Path(directory)
+        self.frames = frames
+        self.top = top
+        self.session: ProfilingSession | None = None
+        self.timer: asyncio.Task | None = None
+
+    @property
+    def active(self) -> bool:
+        return self.session is not None
+
+    def start(
+        self, bot: Bot, chat_id: int, requests: int | None, seconds: float
+    ) -> bool:
+        """
+        :param bot: Bot instance to send the summary with
+        :param chat_id: Admin chat id
+        :param requests: Requests to profile, None - until the time is over
+        :param seconds: Max profiling time
+        :return: False if other session is running
+        """
+        if self.session is not None:
+            return False
+        self.session = ProfilingSession(chat_id, requests, seconds, self.frames)
+        self.timer = asyncio.create_task(self._stop_later(bot, seconds))
+        logger.info("Profiling started: %s requests, %s s", requests, seconds)
+        return True
+
+    def request_done(self, bot: Bot) -> None:
+        session = self.session
+        if session is None:
+            return
+        session.handled += 1
+        if session.requests_left is None:
+            return
+        session.requests_left -= 1
+        if session.requests_left <= 0:
+            self.timer.cancel()
+            self.timer = asyncio.create_task(self.finish(bot))
+
+    async def _stop_later(self, bot: Bot, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+        await self.finish(bot)
+
+    async def finish(self, bot: Bot) -> None:
+        session, self.session = self.session, None
+        if session is None:
+            return
+        session.stop()
+        try:
+            summary = self._save(session)
+        except Exception as ex:
+            logger.error("Cannot save profile: %s", ex)
+            summary = f"Cannot save profile: {ex}"
+        finally:
+            if session.trace_memory:
+                tracemalloc.stop()
+        logger.info("Profiling finished, %s requests", session.handled)
+        await bot.send_message(
+            session.chat_id,
+            f"<pre>{html.escape(summary[: MAX_SUMMARY_LENGTH - 20], quote=False)}</pre>",
+        )
+
+    def _save(self, session: ProfilingSession) -> str:
+        """
+        Write the profile files
+        :return: Summary text
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        base = self.directory / session.name
+        elapsed = time.perf_counter() - session.started_at
+        lines = [
+            f"Profile {session.name}: {session.handled} requests in {elapsed:.1f} s",
+            "",
+            "Stages, total s / count / mean ms:",
+            *self._timings(session.stages, STAGE_LATENCY.totals()),
+            "",
+            "Handlers, total s / count / mean ms:",
+            *self._timings(session.handlers, HANDLER_LATENCY.totals()),
+            "",
+            "CPU hotspots, own s / cumulative s / calls:",
+        ]
+        session.profile.dump_stats(f"{base}.prof")
+        stats = pstats.Stats(session.profile)
+        hotspots = sorted(
+            stats.stats.items(), key=lambda item: item[1][2], reverse=True
+        )
+        for (filename, line, function), (_, calls, own, cumulative, _) in hotspots[
+            : self.top
+        ]:
+            lines.append(
+                f"{own:.3f} {cumulative:.3f} {calls} {function} ({Path(filename).name}:{line})"
+            )
+        if session.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(f"{base}.tracemalloc")
+            # Profiler's own allocations are not interesting
+            snapshot = snapshot.filter_traces(
+                [
+                    tracemalloc.Filter(False, module.__file__)
+                    for module in (cProfile, pstats, tracemalloc)
+                ]
+                + [tracemalloc.Filter(False, __file__)]
+            )
+            current, peak = tracemalloc.get_traced_memory()
+            lines += [
+                "",
+                f"Memory, current {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB:",
+            ]
+            for statistic in snapshot.statistics("lineno")[: self.top]:
+                frame = statistic.traceback[0]
+                lines.append(
+                    f"{statistic.size / 2 ** 10:.0f} KiB {statistic.count} blocks"
+                    f" ({Path(frame.filename).name}:{frame.lineno})"
+                )
+        lines += ["", f"Files: {base}.*"]
+        summary = "\n".join(lines)
+        Path(f"{base}.txt").write_text(summary, encoding="utf-8")
+        return summary
+
+    @staticmethod
+    def _timings(
+        before: Dict[LabelValues, Tuple[float, int]],
+        after: Dict[LabelValues, Tuple[float, int]],
+    ) -> List[str]:
+        lines = []
+        for key, (total, count) in sorted(after.items()):
+            total_before, count_before = before.get(key, (0.0, 0))
+            total, count = total - total_before, count - count_before
+            if count:
+                lines.append(
+                    f"{'/'.join(key)}: {total:.3f} / {count} / {total / count * 1000:.1f}"
+                )
+        return lines or ["-"]
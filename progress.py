@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+from typing import List
+
+from aiogram import Bot
+from aiogram.enums import ChatAction
+
+from config import ProgressMode
+from outbound import Priority, StaleRequestError, request_priority
+
+logger = logging.getLogger(__name__)
+
+CLOCK_ICONS: List[str] = [
+    "🕐",
+    "🕑",
+    "🕒",
+    "🕓",
+    "🕔",
+    "🕕",
+    "🕖",
+    "🕗",
+    "🕘",
+    "🕙",
+    "🕚",
+    "🕛",
+]
+
+# Telegram shows chat action for 5 seconds, repeat it a bit earlier
+CHAT_ACTION_REPEAT = 4.0
+
+
+class Spinner:
+    """
+    Progress indicator state of the single long operation
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, show_at: float):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.next_call_at = show_at
+        self.icon_index = 0
+        self.message_id: int | None = None
+        self.done = False
+
+
+class ProgressTicker:
+    """
+    Shows progress of all long operations from the single background task.\r\n
+    Nothing is shown for operations shorter than delay. Each tick makes at most
+    max_calls_per_tick API calls, so the spinner traffic does not grow with the count
+    of operations in flight: spinners just update less often.
+    """
+
+    def __init__(
+        self,
+        mode: ProgressMode,
+        delay: float,
+        interval: float,
+        max_calls_per_tick: int,
+    ):
+        """
+        :param mode: Show clock message or send upload_document chat action
+        :param delay: Seconds before the progress is shown
+        :param interval: Seconds between ticks
+        :param max_calls_per_tick: API calls limit for the single tick
+        """
+        self.mode = mode
+        self.delay = delay
+        self.interval = interval
+        self.max_calls_per_tick = max_calls_per_tick
+        self.spinners: List[Spinner] = []
+        self.task: asyncio.Task | None = None
+
+    def add(self, bot: Bot, chat_id: int) -> Spinner:
+        spinner = Spinner(bot, chat_id, show_at=time.monotonic() + self.delay)
+        self.spinners.append(spinner)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return spinner
+
+    async def remove(self, spinner: Spinner) -> None:
+        spinner.done = True
+        if spinner in self.spinners:
+            self.spinners.remove(spinner)
+        await self._hide(spinner)
+
+    async def _run(self) -> None:
+        # Spinner requests give way to the documents and replies
+        request_priority.set(Priority.PROGRESS)
+        while self.spinners:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._tick()
+            except Exception as ex:
+                logger.error("Progress tick failed: %s", ex)
+
+    async def _tick(self) -> None:
+        now = time.monotonic()
+        due = [spinner for spinner in self.spinners if spinner.next_call_at <= now]
+        # Longest waiting first, so the limited calls are spread across all spinners
+        due.sort(key=lambda spinner: spinner.next_call_at)
+        results = await asyncio.gather(
+            *(self._update(spinner) for spinner in due[: self.max_calls_per_tick]),
+            return_exceptions=True,
+        )
+        for result in results:
+            # Replaced by a newer update of the same spinner
+            if isinstance(result, StaleRequestError):
+                continue
+            if isinstance(result, Exception):
+                logger.warning("Cannot update progress: %s", result)
+
+    async def _update(self, spinner: Spinner) -> None:
+        now = time.monotonic()
+        if self.mode == ProgressMode.CHAT_ACTION:
+            spinner.next_call_at = now + CHAT_ACTION_REPEAT
+            await spinner.bot.send_chat_action(
+                spinner.chat_id, ChatAction.UPLOAD_DOCUMENT
+            )
+            return
+
+        spinner.next_call_at = now + self.interval
+        if spinner.message_id is None:
+            message = await spinner.bot.send_message(
+                spinner.chat_id, CLOCK_ICONS[spinner.icon_index]
+            )
+            spinner.message_id = message.message_id
+            if spinner.done:
+                # Operation finished while the message was being sent
+                await self._hide(spinner)
+            return
+        if spinner.done:
+            return
+        spinner.icon_index = (spinner.icon_index + 1) % len(CLOCK_ICONS)
+        await spinner.bot.edit_message_text(
+            CLOCK_ICONS[spinner.icon_index],
+            chat_id=spinner.chat_id,
+            message_id=spinner.message_id,
+        )
+
+    @staticmethod
+    async def _hide(spinner: Spinner) -> None:
+        if spinner.message_id is None:
+            return
+        message_id, spinner.message_id = spinner.message_id, None
+        try:
+            await spinner.bot.delete_message(spinner.chat_id, message_id)
+        except Exception as ex:
+            logger.error(
+                "Cannot delete timer message %s in chat %s: %s",
+                message_id,
+                spinner.chat_id,
+                ex,
+            )
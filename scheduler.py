@@ -0,0 +1,140 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class SchedulerBusy(Exception):
+    """
+    The user already has too many operations queued
+    """
+
+
+class FairScheduler:
+    """
+    Runs long operations in a bounded pool of slots, serving users round-robin.\r\n
+    A user who sends a lot of messages waits for their own operations,
+    other users' operations still get the next free slots.
+    """
+
+    def __init__(self, workers: int, max_queue_per_user: int):
+        """
+        :param workers: Max operations running at the same time
+        :param max_queue_per_user: Max queued and running operations of the single user
+        """
+        self.workers = workers
+        self.max_queue_per_user = max_queue_per_user
+        self.running = 0
+        # user id -> operations waiting for a slot, in order of users turn
+        self.queues: OrderedDict[int, Deque[asyncio.Future]] = OrderedDict()
+        self.user_running: Dict[int, int] = {}
+        self.rejected = 0
+        self.completed = 0
+        self.queue_time_sum = 0.0
+        self.queue_time_max = 0.0
+        self.run_time_sum = 0.0
+        self.run_time_max = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def user_depth(self, user_id: int) -> int:
+        return len(self.queues.get(user_id, ())) + self.user_running.get(user_id, 0)
+
+    async def run(self, user_id: int, operation: Callable[[], Awaitable[T]]) -> T:
+        """
+        Wait for the user turn and a free slot, then run the operation
+        :param user_id: TG user id
+        :param operation: Long operation
+        :return: Operation result
+        :raise SchedulerBusy: The user queue is full
+        """
+        if self.user_depth(user_id) >= self.max_queue_per_user:
+            self.rejected += 1
+            raise SchedulerBusy(user_id)
+
+        queued_at = time.monotonic()
+        await self._acquire(user_id)
+        started_at = time.monotonic()
+        try:
+            return await operation()
+        finally:
+            finished_at = time.monotonic()
+            self._release(user_id)
+            self.completed += 1
+            queue_time = started_at - queued_at
+            run_time = finished_at - started_at
+            self.queue_time_sum += queue_time
+            self.queue_time_max = max(self.queue_time_max, queue_time)
+            self.run_time_sum += run_time
+            self.run_time_max = max(self.run_time_max, run_time)
+
+    async def _acquire(self, user_id: int) -> None:
+        if self.running < self.workers and not self.queues:
+            self._start(user_id)
+            return
+        turn = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append(turn)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # Slot was granted right before the cancellation
+                self._release(user_id)
+            else:
+                self._forget(user_id, turn)
+            raise
+
+    def _start(self, user_id: int) -> None:
+        self.running += 1
+        self.user_running[user_id] = self.user_running.get(user_id, 0) + 1
+
+    def _release(self, user_id: int) -> None:
+        self.running -= 1
+        self.user_running[user_id] -= 1
+        if not self.user_running[user_id]:
+            del self.user_running[user_id]
+        self._dispatch()
+
+    def _forget(self, user_id: int, turn: asyncio.Future) -> None:
+        queue = self.queues.get(user_id)
+        if queue is None:
+            return
+        if turn in queue:
+            queue.remove(turn)
+        if not queue:
+            del self.queues[user_id]
+
+    def _dispatch(self) -> None:
+        while self.running < self.workers and self.queues:
+            # Take the user at the head of the round and move them to its tail
+            user_id, queue = next(iter(self.queues.items()))
+            turn = queue.popleft()
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            if turn.done():
+                continue
+            self._start(user_id)
+            turn.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "users_waiting": len(self.queues),
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "queue_time_avg": (
+                self.queue_time_sum / self.completed if self.completed else 0.0
+            ),
+            "queue_time_max": self.queue_time_max,
+            "run_time_avg": (
+                self.run_time_sum / self.completed if self.completed else 0.0
+            ),
+            "run_time_max": self.run_time_max,
+        }
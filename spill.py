@@ -0,0 +1,98 @@
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    """
+    Bytes of media and documents the process may keep in memory at once.\r\n
+    Nothing waits for the budget: content that doesn't fit goes to temp files.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: Max bytes held in memory by all requests
+        """
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.spilled = 0
+        self.spilled_bytes = 0
+
+    def reserve(self, size: int) -> bool:
+        """
+        :param size: Bytes to keep in memory
+        :return: False if the budget is exhausted, the caller has to spill to disk
+        """
+        if self.used + size > self.max_bytes:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int) -> None:
+        self.used -= size
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_bytes": self.max_bytes,
+            "used": self.used,
+            "spilled": self.spilled,
+            "spilled_bytes": self.spilled_bytes,
+        }
+
+
+class SpillScope:
+    """
+    Memory reservations and temp files of the single conversion,
+    all of them are released by close()
+    """
+
+    def __init__(
+        self, budget: MemoryBudget, threshold: int, directory: str | None = None
+    ):
+        """
+        :param budget: Process memory budget
+        :param threshold: Content larger than this always goes to disk
+        :param directory: Temp files directory, system default if None
+        """
+        self.budget = budget
+        self.threshold = threshold
+        self.directory = directory
+        self.reserved = 0
+        self.paths: List[Path] = []
+
+    def reserve(self, size: int) -> bool:
+        """
+        :param size: Bytes to keep in memory
+        :return: True if the content may stay in memory, False if it has to be spilled
+        """
+        if size > self.threshold or not self.budget.reserve(size):
+            self.budget.spilled += 1
+            self.budget.spilled_bytes += size
+            return False
+        self.reserved += size
+        return True
+
+    def temp_path(self, suffix: str = "") -> Path:
+        """
+        New empty temp file, removed by close()
+        """
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.directory)
+        os.close(fd)
+        self.paths.append(Path(path))
+        return self.paths[-1]
+
+    def close(self) -> None:
+        self.budget.release(self.reserved)
+        self.reserved = 0
+        for path in self.paths:
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as ex:
+                logger.error("Cannot remove temp file %s: %s", path, ex)
+        self.paths.clear()
@@ -0,0 +1,11 @@
+import os
+import sys
+from pathlib import Path
+
+# Modules of the bot are in the repository root
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# Required settings, the tests make no requests with them
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+os.environ.setdefault("BOT_ADMIN_CHAT_ID", '["1"]')
+os.environ.setdefault("REDIS_PASSWORD", "test")
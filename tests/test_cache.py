@@ -0,0 +1,44 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from cache import LocaleCache
+
+
+class PublishingRedis:
+    def __init__(self):
+        self.messages = []
+
+    async def publish(self, channel: str, message: str):
+        self.messages.append(message)
+
+
+def test_locale_is_cached_per_chat():
+    cache = LocaleCache(max_items=10, ttl=60)
+    private = StorageKey(bot_id=1, chat_id=7, user_id=7)
+    group = StorageKey(bot_id=1, chat_id=-100, user_id=7)
+    cache.put(private, "ru")
+    assert cache.get(private) == "ru"
+    assert cache.get(group) is None
+
+
+def test_locale_invalidation_drops_the_storage_key():
+    async def run():
+        redis = PublishingRedis()
+        sender = LocaleCache(max_items=10, ttl=60, redis=redis)
+        receiver = LocaleCache(max_items=10, ttl=60)
+        private = StorageKey(bot_id=1, chat_id=7, user_id=7)
+        thread = StorageKey(bot_id=1, chat_id=-100, user_id=7, thread_id=3)
+        receiver.put(private, "en")
+        receiver.put(thread, "en")
+        await sender.set(thread, "ru")
+        receiver._invalidate(redis.messages[0].encode())
+        # Own messages are ignored
+        sender._invalidate(redis.messages[0])
+        return sender, receiver, private, thread
+
+    sender, receiver, private, thread = asyncio.run(run())
+    assert receiver.get(thread) is None
+    assert receiver.get(private) == "en"
+    assert sender.get(thread) == "ru"
+    assert receiver.invalidations == 1
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from aiogram import Bot
+from aiogram.types import MessageEntity
+
+from config import ExecutorMode
+from executor import ConversionExecutor
+from utils import parse_html_to_md
+
+TEXT = "bold link " * 300
+
+
+def bound_entities(bot: Bot):
+    # Entities of the received messages are bound to the bot, like these
+    return [
+        MessageEntity(type="bold", offset=0, length=4).as_(bot),
+        MessageEntity(
+            type="text_link", offset=5, length=4, url="https://example.com"
+        ).as_(bot),
+    ]
+
+
+@pytest.mark.parametrize("mode", list(ExecutorMode))
+def test_parse_offloaded(mode: ExecutorMode):
+    async def run():
+        bot = Bot(token="42:TEST")
+        executor = ConversionExecutor(
+            mode, workers=1, parse_min_chars=100, encode_min_bytes=1024
+        )
+        try:
+            entities = bound_entities(bot)
+            result = await executor.parse(TEXT, entities)
+            assert result == parse_html_to_md(TEXT, entities)
+            assert executor.parsed == 1
+        finally:
+            executor.pool.shutdown()
+            await bot.session.close()
+
+    asyncio.run(run())
+
+
+def test_parse_many_offloads_total_length():
+    async def run():
+        executor = ConversionExecutor(
+            ExecutorMode.PROCESS, workers=1, parse_min_chars=100, encode_min_bytes=1024
+        )
+        items = [("short text", [MessageEntity(type="bold", offset=0, length=5)])] * 20
+        try:
+            assert await executor.parse_many(items) == ["**short** text"] * 20
+            assert executor.parsed == 20
+        finally:
+            executor.pool.shutdown()
+
+    asyncio.run(run())
+
+
+def test_small_text_stays_inline():
+    async def run():
+        executor = ConversionExecutor(
+            ExecutorMode.PROCESS, workers=1, parse_min_chars=100, encode_min_bytes=1024
+        )
+        assert await executor.parse("short", None) == "short"
+        assert executor.pool is None
+
+    asyncio.run(run())
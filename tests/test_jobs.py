@@ -0,0 +1,35 @@
+import asyncio
+
+from jobs import JobQueue
+
+
+class StreamRedis:
+    """
+    Redis stub returning the given XAUTOCLAIM and XREADGROUP replies
+    """
+
+    def __init__(self, claimed, new):
+        self.claimed = claimed
+        self.new = new
+
+    async def xautoclaim(self, name, group, consumer, min_idle_time, count):
+        return b"0-0", self.claimed, []
+
+    async def xreadgroup(self, group, consumer, streams, count, block):
+        return [[b"jobs", self.new]] if self.new else []
+
+
+def read(redis: StreamRedis):
+    queue = JobQueue(redis, stream="jobs", group="workers", dead_letter_stream="dead")
+    return asyncio.run(queue._read("worker", count=10, block=0))
+
+
+def test_claimed_entries_are_flagged():
+    redis = StreamRedis(claimed=[(b"1-0", {b"chat_id": b"7"})], new=[])
+    assert read(redis) == ([("1-0", {"chat_id": "7"})], True)
+
+
+def test_new_entries_after_deleted_claimed_are_not_flagged():
+    # The claimed entry was deleted from the stream, XAUTOCLAIM returns no fields
+    redis = StreamRedis(claimed=[(b"1-0", None)], new=[(b"2-0", {b"chat_id": b"7"})])
+    assert read(redis) == ([("2-0", {"chat_id": "7"})], False)
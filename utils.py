@@ -1,172 +1,187 @@
-from typing import List
+from typing import Dict, List, NamedTuple, Tuple
 
 from aiogram.enums import MessageEntityType
 from aiogram.types import MessageEntity
 
 
-def parse_html_to_md(html_text: str, entities: List[MessageEntity] | None):
-    if not entities or not len(entities):
-        return html_text
-
-    type_priority = {
-        MessageEntityType.BOLD: 0,
-        MessageEntityType.ITALIC: 0,
-        MessageEntityType.UNDERLINE: 0,
-        MessageEntityType.STRIKETHROUGH: 0,
-        MessageEntityType.BLOCKQUOTE: 0,
-        MessageEntityType.PRE: 1,
-        MessageEntityType.CODE: 2,
-        MessageEntityType.TEXT_LINK: 3,
-        MessageEntityType.CUSTOM_EMOJI: 4,
-    }
-
-    sorted_entities = sorted(
-        filter(lambda x: x.type in type_priority.keys(), entities),
-        key=lambda x: type_priority.get(x.type, float("inf")),
-    )
+# Entity type -> (opening, closing) markdown chars for plain inline formatting
+FORMATTING_MD_CHARS: Dict[str, Tuple[str, str]] = {
+    MessageEntityType.BOLD: ("**", "**"),
+    MessageEntityType.ITALIC: ("*", "*"),
+    MessageEntityType.UNDERLINE: ("**", "**"),
+    MessageEntityType.STRIKETHROUGH: ("~~", "~~"),
+    MessageEntityType.BLOCKQUOTE: ("", ""),
+    MessageEntityType.CODE: ("`", "`"),
+}
 
-    html_text = parse_by_entity(html_text, sorted_entities)
+# Entities whose content is emitted as is, without any nested formatting
+VERBATIM_ENTITY_TYPES = {
+    MessageEntityType.PRE,
+    MessageEntityType.CODE,
+}
 
-    return html_text
+TELEGRAPH_IMAGE_TEXT = "\u200b\u200b"
+TELEGRAPH_IMAGE_PREFIX = "https://telegra.ph/file/"
 
 
-def parse_by_entity(html_text: str, entities: List[MessageEntity]):
-    for entity in entities:
-        if entity.type == MessageEntityType.BOLD:
-            html_text = replace_html_formatting_to_md(html_text, "<b>", "**")
-            continue
-        if entity.type == MessageEntityType.ITALIC:
-            html_text = replace_html_formatting_to_md(html_text, "<i>", "*")
-            continue
-        if entity.type == MessageEntityType.BLOCKQUOTE:
-            html_text = replace_html_formatting_to_md(html_text, "<blockquote>", "")
-            continue
-        if entity.type == MessageEntityType.UNDERLINE:
-            html_text = replace_html_formatting_to_md(html_text, "<u>", "**")
-            continue
-        if entity.type == MessageEntityType.STRIKETHROUGH:
-            html_text = replace_html_formatting_to_md(html_text, "<s>", "~~")
-            continue
-        if entity.type == MessageEntityType.CODE:
-            html_text = replace_html_formatting_to_md(html_text, "<code>", "`")
-            continue
-        if entity.type == MessageEntityType.TEXT_LINK:
-            html_text = replace_html_links_to_md(html_text)
-            continue
-        if entity.type == MessageEntityType.PRE:
-            html_text = replace_html_code_block_to_md(html_text)
-            continue
-        if entity.type == MessageEntityType.CUSTOM_EMOJI:
-            html_text = replace_tg_emoji_link_to_text(html_text)
-            continue
+class _Span(NamedTuple):
+    start: int
+    end: int
+    opening: str
+    closing: str
+    verbatim: bool
+    replace: bool
 
-    return html_text
-
-
-def replace_html_formatting_to_md(
-    html_text: str, html_chars: str, md_chars: str, start_index: int = 0
-):
-    find_start_index = html_text.find(html_chars, start_index)
-    find_end_index = html_text.find(html_chars.replace("<", "</"), start_index)
-    if find_start_index == -1 or find_end_index == -1:
-        return html_text
-    len_html_chars = len(html_chars)
-    unknown_newline_counter = 0
-    while html_text[find_end_index - 1] == "\n":
-        find_end_index -= 1
-        unknown_newline_counter += 1
-    html_text = (
-        html_text[:find_start_index]
-        + md_chars
-        + html_text[find_start_index + len_html_chars : find_end_index]
-        + md_chars
-        + "\n" * unknown_newline_counter
-        + html_text[find_end_index + unknown_newline_counter + len_html_chars + 1 :]
-    )
-    if html_text.find(html_chars, find_end_index) != -1:
-        html_text = replace_html_formatting_to_md(
-            html_text,
-            html_chars,
-            md_chars,
-            find_end_index - (len_html_chars * 2 + 1) + (len(md_chars) * 2),
-        )
-    return html_text
-
-
-def replace_tg_emoji_link_to_text(html_text: str, start_index: int = 0):
-    find_start_index = html_text.find('<tg-emoji emoji-id="', start_index)
-    find_end_index = html_text.find("</tg-emoji>", start_index)
-    if find_start_index == -1 or find_end_index == -1:
-        return html_text
-    cur_text_len = len(html_text)
-    html_text = (
-        html_text[:find_start_index]
-        + html_text[find_end_index - 1]
-        + html_text[find_end_index + 11 :]
-    )
-    if html_text.find('<tg-emoji emoji-id="', find_end_index) != -1:
-        html_text = replace_tg_emoji_link_to_text(
-            html_text, find_end_index - (cur_text_len - len(html_text))
-        )
-    return replace_tg_emoji_link_to_text(html_text)
+
+def parse_html_to_md(text: str | None, entities: List[MessageEntity] | None) -> str:
+    """
+    Render telegram text with entities to markdown in a single pass.\r\n
+    Entities offsets are used directly instead of searching html tags in
+    the html representation of the message, so conversion is linear in the text length.
+    :param text: Plain message text or caption (not html_text)
+    :param entities: Message entities or caption entities
+    :return: Markdown text
+    """
+    if not text:
+        return ""
+    if not entities:
+        return text
+
+    spans = _build_spans(text, entities)
+    if not spans:
+        return text
+    return _render_spans(text, spans)
 
 
-def replace_html_links_to_md(html_text: str, start_index: int = 0):
+def _utf16_to_index_map(text: str, offsets: List[int]) -> Dict[int, int]:
     """
-    Replace html-links to markdown syntax in all html_text.\r\n
-    Example:  \n
-    From - <a href="https://google.com/">link</a> \n
-    To - [link](https://google.com/)
-    :param html_text: Текст html
-    :param start_index:
-    :return:
+    Map telegram UTF-16 offsets to python string indices in one walk over the text
+    :param text: Message text
+    :param offsets: UTF-16 offsets to map
+    :return: Dict of UTF-16 offset -> python string index
     """
-    find_start_index = html_text.find('<a href="', start_index)
-    find_end_index = html_text.find("</a>", start_index)
-    if find_start_index == -1 or find_end_index == -1:
-        return html_text
-
-    full_link = html_text[find_start_index : find_end_index + 4]
-    link_url = full_link.split('<a href="')[1].split('">')[0]
-    link_text = full_link.split('">')[1].split("</a>")[0]
-    if link_text == "\u200b\u200b" and link_url.startswith("https://telegra.ph/file/"):
-        html_text = html_text.replace(full_link, f"![{link_url}]({link_url})\n")
-    else:
-        html_text = html_text.replace(full_link, f"[{link_text}]({link_url})")
-
-    if html_text.find('<a href="', find_end_index) != -1:
-        # -11 - it's a diff len of char between html link and markdown link without data
-        # <a href=""></a> - 15
-        # []() - 4
-        html_text = replace_html_links_to_md(html_text, find_end_index - 11)
-    return html_text
-
-
-def replace_html_code_block_to_md(html_text: str, start_index: int = 0):
-    find_start_index = html_text.find("<pre>", start_index)
-    find_end_index = html_text.find("</pre>", start_index)
-    if find_start_index == -1 or find_end_index == -1:
-        return html_text
-
-    code_string = html_text[find_start_index : find_end_index + 6]
-    code_lang = ""
-
-    cur_text_len = len(html_text)
-
-    if code_string.startswith('<pre><code class="language-'):
-        code_lang = code_string.split("language-")[1].split('">')[0]
-        html_text = html_text.replace(
-            code_string,
-            f"""```{code_lang}\n{code_string.split('">')[1].split('</code>')[0]}\n```\n""",
-        )
-    else:
-        html_text = html_text.replace(
-            code_string,
-            f"```{code_lang}\n{code_string.split('<pre>')[1].split('</pre>')[0]}\n```\n",
-        )
+    if text.isascii() or len(text.encode("utf-16-le")) == len(text) * 2:
+        # BMP-only text: UTF-16 code units and python indices are the same
+        return {offset: min(offset, len(text)) for offset in offsets}
+
+    result: Dict[int, int] = {}
+    pending = sorted(set(offsets))
+    pending_index = 0
+    utf16_position = 0
+    for index, char in enumerate(text):
+        while pending_index < len(pending) and pending[pending_index] <= utf16_position:
+            result[pending[pending_index]] = index
+            pending_index += 1
+        if pending_index == len(pending):
+            return result
+        utf16_position += 2 if ord(char) > 0xFFFF else 1
+    for offset in pending[pending_index:]:
+        result[offset] = len(text)
+    return result
+
+
+def _entity_md_chars(entity: MessageEntity) -> Tuple[str, str, bool] | None:
+    """
+    Markdown representation of the entity
+    :param entity: TG Message entity
+    :return: (opening, closing, replace content) or None for entities rendered as plain text
+    """
+    if entity.type in FORMATTING_MD_CHARS:
+        opening, closing = FORMATTING_MD_CHARS[entity.type]
+        return opening, closing, False
+    if entity.type == MessageEntityType.PRE:
+        return f"```{entity.language or ''}\n", "\n```\n", False
+    if entity.type == MessageEntityType.TEXT_LINK:
+        return "[", f"]({entity.url})", False
+    return None
+
+
+def _build_spans(text: str, entities: List[MessageEntity]) -> List[_Span]:
+    index_map = _utf16_to_index_map(
+        text,
+        [entity.offset for entity in entities]
+        + [entity.offset + entity.length for entity in entities],
+    )
 
-    if html_text.find("<pre>", find_end_index) != -1:
-        html_text = replace_html_code_block_to_md(
-            html_text, find_end_index - (cur_text_len - len(html_text))
+    spans: List[_Span] = []
+    for entity in entities:
+        md_chars = _entity_md_chars(entity)
+        if md_chars is None:
+            continue
+        opening, closing, replace = md_chars
+        start = index_map[entity.offset]
+        end = index_map[entity.offset + entity.length]
+        if entity.type == MessageEntityType.TEXT_LINK:
+            if text[start:end] == TELEGRAPH_IMAGE_TEXT and (
+                entity.url.startswith(TELEGRAPH_IMAGE_PREFIX)
+            ):
+                opening, closing, replace = f"![{entity.url}]({entity.url})\n", "", True
+        elif entity.type != MessageEntityType.PRE:
+            # Closing chars must stick to the text, keep trailing newlines after them
+            while end > start and text[end - 1] == "\n":
+                end -= 1
+        if start >= end:
+            continue
+        spans.append(
+            _Span(
+                start=start,
+                end=end,
+                opening=opening,
+                closing=closing,
+                verbatim=replace or entity.type in VERBATIM_ENTITY_TYPES,
+                replace=replace,
+            )
         )
-    return html_text
+
+    # Outer entities first, drop everything nested into code blocks
+    spans.sort(key=lambda span: (span.start, -span.end, not span.verbatim))
+    result: List[_Span] = []
+    verbatim_end = -1
+    for span in spans:
+        if span.start < verbatim_end:
+            continue
+        if span.verbatim:
+            verbatim_end = span.end
+        result.append(span)
+    return result
+
+
+def _render_spans(text: str, spans: List[_Span]) -> str:
+    starts: Dict[int, List[_Span]] = {}
+    ends: Dict[int, int] = {}
+    for span in spans:
+        starts.setdefault(span.start, []).append(span)
+        ends[span.end] = ends.get(span.end, 0) + 1
+
+    parts: List[str] = []
+    stack: List[_Span] = []
+    position = 0
+    replaced = 0
+    for boundary in sorted(starts.keys() | ends.keys()):
+        if not replaced:
+            parts.append(text[position:boundary])
+        position = boundary
+
+        closing_count = ends.get(boundary, 0)
+        reopen: List[_Span] = []
+        while closing_count:
+            # Intersecting entities: close inner ones and reopen them after
+            span = stack.pop()
+            parts.append(span.closing)
+            if span.end == boundary:
+                closing_count -= 1
+                replaced -= span.replace
+            else:
+                reopen.append(span)
+        for span in reversed(reopen):
+            parts.append(span.opening)
+            stack.append(span)
+
+        for span in starts.get(boundary, ()):
+            parts.append(span.opening)
+            stack.append(span)
+            replaced += span.replace
+
+    if not replaced:
+        parts.append(text[position:])
+    return "".join(parts)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import multiprocessing
+from multiprocessing import Queue
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Dict, List, Set
+
+from aiogram import Bot, Dispatcher
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+worker_processes: List[BaseProcess] = []
+
+
+def route_key(update: Dict[str, Any]) -> int:
+    """
+    Chat id of the update, all updates of the chat are routed to the same worker,
+    so album parts and per-chat ordering stay in one process
+    :param update: Raw TG update
+    :return: Chat id, user id for updates without chat, 0 if neither found
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+    return 0
+
+
+def start_workers(count: int, target: Callable[[Queue, int], None]) -> List[Queue]:
+    """
+    Start webhook worker processes, must be called before the listener event loop starts
+    :param count: Workers count
+    :param target: Worker process entry point, gets its updates queue and index
+    :return: Updates queue of each worker
+    """
+    context = multiprocessing.get_context("spawn")
+    queues = []
+    for index in range(count):
+        queue = context.Queue()
+        process = context.Process(
+            target=target,
+            args=(queue, index),
+            name=f"webhook-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        worker_processes.append(process)
+        queues.append(queue)
+    return queues
+
+
+async def consume_updates(dp: Dispatcher, bot: Bot, updates: Queue) -> None:
+    """
+    Worker side: feed updates from the queue to the dispatcher until None is received
+    :param dp: Dispatcher with the handlers and middlewares
+    :param bot: Bot instance
+    :param updates: Updates queue of the worker
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    tasks: Set[asyncio.Task] = set()
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    try:
+        while (update := await loop.run_in_executor(None, updates.get)) is not None:
+            task = asyncio.create_task(dp.feed_raw_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        await bot.session.close()
+
+
+async def run_webhook_listener(
+    bot: Bot, allowed_updates: List[str], queues: List[Queue]
+) -> None:
+    """
+    Listener side: receive webhook updates and route them to the workers by chat id
+    :param bot: Bot instance
+    :param allowed_updates: Update types used by the dispatcher
+    :param queues: Updates queues of the workers
+    :return:
+    """
+    if not config.WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is required in webhook run mode")
+    # Only the listener process serves HTTP, workers don't import aiohttp.web
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        if config.WEBHOOK_SECRET and (
+            request.headers.get(SECRET_HEADER) != config.WEBHOOK_SECRET
+        ):
+            return web.Response(status=401)
+        update = await request.json()
+        queues[route_key(update) % len(queues)].put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(config.WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT).start()
+
+    await bot.set_webhook(
+        url=f"{config.WEBHOOK_URL.rstrip('/')}{config.WEBHOOK_PATH}",
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=allowed_updates,
+    )
+    logger.info(
+        "Webhook listener on %s:%s, %s workers",
+        config.WEBHOOK_HOST,
+        config.WEBHOOK_PORT,
+        len(queues),
+    )
+    try:
+        while all(process.is_alive() for process in worker_processes):
+            await asyncio.sleep(1)
+        logger.error("Webhook worker process exited, stopping the listener")
+    finally:
+        await runner.cleanup()
+        for queue in queues:
+            queue.put(None)
+        await bot.session.close()
@@ -0,0 +1,15 @@
+"""
+Conversion worker of the queue conversion mode (CONVERSION_MODE=queue).
+
+Start as many workers as needed on any node with access to the bot Redis:
+    python worker.py
+"""
+
+import asyncio
+
+from logs import setup_logging
+from main import run_conversion_worker
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(run_conversion_worker())